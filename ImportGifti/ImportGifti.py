@@ -1,5 +1,8 @@
 import os
 import unittest
+import concurrent.futures
+import contextlib
+import importlib.util
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
@@ -7,6 +10,8 @@ import numpy as np
 import re
 from pathlib import Path
 
+from ImportGiftiLib import CLOSED_SURFACE_OPTIONS, ImportGiftiConverter
+
 #
 # ImportGifti. Module to load gifti files into 3D Slicer.
 #
@@ -32,6 +37,209 @@ class ImportGifti(ScriptedLoadableModule):
         """
 
 
+#
+# ImportGifti files table
+#
+
+
+class ImportGiftiFilesModel(qt.QAbstractTableModel):
+    """
+    Model of the files of the selected subject shown in the files table: the filename and
+    whether the file is converted and visible (checkable columns). A file can only be visible
+    if it is converted. The view only asks for the rows it shows.
+    """
+
+    FilenameColumn = 0
+    ConvertColumn = 1
+    VisibleColumn = 2
+    headers = ["Filename", "Convert", "Visible"]
+
+    def __init__(self, parent=None):
+        qt.QAbstractTableModel.__init__(self, parent)
+        self.filenames = []
+        # Check state of each file in the 'Convert' and 'Visible' columns, and number of files
+        # checked in each column (kept up to date, so that the files are not scanned)
+        self.checked = {self.ConvertColumn: [], self.VisibleColumn: []}
+        self.checkedCount = {self.ConvertColumn: 0, self.VisibleColumn: 0}
+
+    def setFiles(self, filenames):
+        """
+        Replaces the list of files (all of them checked) in a single reset of the model.
+        """
+        self.beginResetModel()
+        self.filenames = list(filenames)
+        self.checked = {
+            self.ConvertColumn: [True] * len(self.filenames),
+            self.VisibleColumn: [True] * len(self.filenames),
+        }
+        self.checkedCount = {
+            self.ConvertColumn: len(self.filenames),
+            self.VisibleColumn: len(self.filenames),
+        }
+        self.endResetModel()
+
+    def rowCount(self, parent=qt.QModelIndex()):
+        return 0 if parent.isValid() else len(self.filenames)
+
+    def columnCount(self, parent=qt.QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=qt.Qt.DisplayRole):
+        if role != qt.Qt.DisplayRole:
+            return None
+        if orientation == qt.Qt.Horizontal:
+            return self.headers[section]
+        # Rows are numbered from 1
+        return section + 1
+
+    def flags(self, index):
+        if not index.isValid():
+            return qt.Qt.NoItemFlags
+        if index.column() == self.FilenameColumn:
+            return qt.Qt.ItemIsEnabled | qt.Qt.ItemIsSelectable
+        return qt.Qt.ItemIsEnabled | qt.Qt.ItemIsUserCheckable
+
+    def data(self, index, role=qt.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row, column = index.row(), index.column()
+        if column == self.FilenameColumn:
+            if role in (qt.Qt.DisplayRole, qt.Qt.ToolTipRole):
+                return self.filenames[row]
+        elif role == qt.Qt.CheckStateRole:
+            return qt.Qt.Checked if self.checked[column][row] else qt.Qt.Unchecked
+        return None
+
+    def setData(self, index, value, role=qt.Qt.EditRole):
+        if (
+            not index.isValid()
+            or index.column() == self.FilenameColumn
+            or role != qt.Qt.CheckStateRole
+        ):
+            return False
+        self.setChecked(index.row(), index.column(), value == qt.Qt.Checked)
+        return True
+
+    def setChecked(self, row, column, checked):
+        """
+        Checks or unchecks a file in the 'Convert' or 'Visible' column.
+        """
+        if column == self.VisibleColumn and not self.checked[self.ConvertColumn][row]:
+            # Visible cannot be checked if convert is unchecked
+            checked = False
+        self._setChecked(row, column, checked)
+        if column == self.ConvertColumn and not checked:
+            self._setChecked(row, self.VisibleColumn, False)
+        self.dataChanged(
+            self.index(row, self.ConvertColumn), self.index(row, self.VisibleColumn)
+        )
+
+    def setAllChecked(self, column, checked):
+        """
+        Checks or unchecks all the files in the 'Convert' or 'Visible' column. The views are
+        notified once for the whole table instead of once per file.
+        """
+        for row in range(len(self.filenames)):
+            if (
+                column == self.VisibleColumn
+                and not self.checked[self.ConvertColumn][row]
+            ):
+                continue
+            self._setChecked(row, column, checked)
+            if column == self.ConvertColumn and not checked:
+                self._setChecked(row, self.VisibleColumn, False)
+        if self.filenames:
+            self.dataChanged(
+                self.index(0, self.ConvertColumn),
+                self.index(len(self.filenames) - 1, self.VisibleColumn),
+            )
+
+    def _setChecked(self, row, column, checked):
+        if self.checked[column][row] != checked:
+            self.checked[column][row] = checked
+            self.checkedCount[column] += 1 if checked else -1
+
+    def isChecked(self, row, column):
+        return self.checked[column][row]
+
+    def allChecked(self, column):
+        return self.checkedCount[column] == len(self.filenames)
+
+    def checkedRows(self, column):
+        """
+        Returns the set of rows checked in the 'Convert' or 'Visible' column.
+        """
+        return {row for row, checked in enumerate(self.checked[column]) if checked}
+
+    def checkedFiles(self, column):
+        """
+        Returns the files checked in the 'Convert' or 'Visible' column, in the table order.
+        """
+        return [
+            filename
+            for filename, checked in zip(self.filenames, self.checked[column])
+            if checked
+        ]
+
+
+class ImportGiftiCheckDelegate(qt.QStyledItemDelegate):
+    """
+    Draws the check boxes of the 'Convert' and 'Visible' columns of the files table centered in
+    their cells, and checks or unchecks them when they are clicked or with the space key. Its
+    parent is the view.
+    """
+
+    def checkRect(self, option):
+        """
+        Returns the rectangle of the check box, centered in the cell.
+        """
+        style = self.parent().style()
+        size = qt.QSize(
+            style.pixelMetric(qt.QStyle.PM_IndicatorWidth),
+            style.pixelMetric(qt.QStyle.PM_IndicatorHeight),
+        )
+        return qt.QStyle.alignedRect(
+            qt.Qt.LeftToRight, qt.Qt.AlignCenter, size, option.rect
+        )
+
+    def paint(self, painter, option, index):
+        style = self.parent().style()
+        # Background of the cell, then the check box
+        style.drawPrimitive(
+            qt.QStyle.PE_PanelItemViewItem, option, painter, self.parent()
+        )
+        checkOption = qt.QStyleOptionButton()
+        checkOption.rect = self.checkRect(option)
+        if index.data(qt.Qt.CheckStateRole) == qt.Qt.Checked:
+            checkOption.state = qt.QStyle.State_Enabled | qt.QStyle.State_On
+        else:
+            checkOption.state = qt.QStyle.State_Enabled | qt.QStyle.State_Off
+        style.drawPrimitive(
+            qt.QStyle.PE_IndicatorCheckBox, checkOption, painter, self.parent()
+        )
+
+    def editorEvent(self, event, model, option, index):
+        if not index.flags() & qt.Qt.ItemIsUserCheckable:
+            return False
+        if event.type() in [qt.QEvent.MouseButtonPress, qt.QEvent.MouseButtonDblClick]:
+            # The check box is toggled when the mouse is released
+            return self.checkRect(option).contains(event.pos())
+        if event.type() == qt.QEvent.MouseButtonRelease:
+            toggle = event.button() == qt.Qt.LeftButton and self.checkRect(
+                option
+            ).contains(event.pos())
+        elif event.type() == qt.QEvent.KeyPress:
+            toggle = event.key() in [qt.Qt.Key_Space, qt.Qt.Key_Select]
+        else:
+            toggle = False
+        if not toggle:
+            return False
+        checked = index.data(qt.Qt.CheckStateRole) == qt.Qt.Checked
+        return model.setData(
+            index, qt.Qt.Unchecked if checked else qt.Qt.Checked, qt.Qt.CheckStateRole
+        )
+
+
 #
 # ImportGifti Widget
 #
@@ -55,7 +263,14 @@ class ImportGiftiWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self._bool_subj = False
         self._dir_selected = False
         self.config = self.resourcePath("Config/config.yml")
-        self.checkboxes = [[], []]
+        self.filesModel = None
+        self.checkDelegate = None
+        # Files of each subject, resolved on demand (see subjectFiles)
+        self.files = {}
+        self._layout = None
+        self._pybids_inputs = {}
+        # Number of subjects after the selected one whose files are resolved in advance
+        self.prefetchSubjects = 3
 
     def setup(self):
         """
@@ -80,12 +295,18 @@ class ImportGiftiWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # UI boot configuration of 'Apply' button and the input box.
         self.ui.applyButton.toolTip = "Please select a path to Hippunfold results"
         self.ui.applyButton.enabled = False
-        # TableWidget to display files
+        # Table to display files
+        self.filesModel = ImportGiftiFilesModel()
+        self.ui.tableFiles.setModel(self.filesModel)
         header = self.ui.tableFiles.horizontalHeader()
         header.setDefaultSectionSize(80)
         header.setSectionResizeMode(0, qt.QHeaderView.Stretch)
         header.setSectionResizeMode(1, qt.QHeaderView.Fixed)
         header.setSectionResizeMode(2, qt.QHeaderView.Fixed)
+        # Check boxes centered in the 'Convert' and 'Visible' columns
+        self.checkDelegate = ImportGiftiCheckDelegate(self.ui.tableFiles)
+        for column in [self.filesModel.ConvertColumn, self.filesModel.VisibleColumn]:
+            self.ui.tableFiles.setItemDelegateForColumn(column, self.checkDelegate)
 
         # Dropdown to select subject
         self.ui.subj.addItems(["Select subject"])
@@ -137,6 +358,12 @@ class ImportGiftiWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         )
         self.ui.VisibleAll.connect("clicked(bool)", self.onVisibleAllChange)
         self.ui.ConvertAll.connect("clicked(bool)", self.onConvertAllChange)
+        # Files checked or unchecked in the table
+        self.filesModel.connect(
+            "dataChanged(QModelIndex,QModelIndex)", self.onFilesCheckChange
+        )
+        # Files of another subject
+        self.filesModel.connect("modelReset()", self.onFilesCheckChange)
         # Buttons
         self.ui.applyButton.connect("clicked(bool)", self.onApplyButton)
 
@@ -155,6 +382,10 @@ class ImportGiftiWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """
         # Parameter node will be reset, do not use it anymore
         self.setParameterNode(None)
+        # Triangles of the removed models do not need to be shared anymore
+        self.logic.clearSharedArrays()
+        self.logic.clearLevelsOfDetail()
+        self.logic.clearColorNodes()
 
     def onSceneEndClose(self, caller, event):
         """
@@ -219,71 +450,45 @@ class ImportGiftiWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """
         if self._parameterNode is None or self._updatingGUIFromParameterNode:
             return
-        # Clean the list of files
-        self.checkboxes = [[], []]
         # Set state of button only if a subj is selected
         if self.ui.subj.currentIndex > 0:
             # Save the state (subject is selected)
             self._bool_subj = True
             # Load the information if
             if self._dir_selected:
-                # Clear the table
-                while self.ui.tableFiles.rowCount > 0:
-                    self.ui.tableFiles.removeRow(0)
-                # Load the files
-                for file, _ in self.files[self.ui.subj.currentText]:
-                    rowPosition = self.ui.tableFiles.rowCount
-                    self.ui.tableFiles.insertRow(rowPosition)
-                    # Use file path without selected parent folder
-                    filename = re.sub(
-                        str(self.ui.InputDirSelector.currentPath), ".", file
-                    )
-                    self.ui.tableFiles.setItem(
-                        rowPosition, 0, qt.QTableWidgetItem(filename)
+                # Load the files, using file paths without selected parent folder
+                self.filesModel.setFiles(
+                    [
+                        re.sub(str(self.ui.InputDirSelector.currentPath), ".", file)
+                        for file, _ in self.subjectFiles(self.ui.subj.currentText)
+                    ]
+                )
+                # The surfaces of the selected subject are shown at full resolution
+                if self.logic.surfaceProxies:
+                    self.logic.setFullResolutionFiles(
+                        [
+                            file
+                            for file, _ in self.subjectFiles(self.ui.subj.currentText)
+                        ]
                     )
-                    # Add the two checkboxes
-                    for i in range(1, 3):
-                        # Construct checkbox and add to table
-                        cell_widget = qt.QWidget()
-                        chk_bx = qt.QCheckBox()
-                        chk_bx.setCheckState(qt.Qt.Checked)
-                        lay_out = qt.QHBoxLayout(cell_widget)
-                        lay_out.addWidget(chk_bx)
-                        lay_out.setAlignment(qt.Qt.AlignCenter)
-                        lay_out.setContentsMargins(0, 0, 0, 0)
-                        cell_widget.setLayout(lay_out)
-                        self.ui.tableFiles.setCellWidget(rowPosition, i, cell_widget)
-                        # Add checkbox object to list
-                        self.checkboxes[i - 1].append(chk_bx)
-                # Update state of check all boxes
-                self.ui.VisibleAll.setText("Uncheck all")
-                self.ui.ConvertAll.setText("Uncheck all")
-                # Connect files checkboxes to function
-                for chk_bx_conv in self.checkboxes[0]:
-                    chk_bx_conv.stateChanged.connect(self.chkBoxConvertChange)
-                for chk_box_vis in self.checkboxes[1]:
-                    chk_box_vis.stateChanged.connect(self.chkBoxVisibleChange)
                 # Enable button
                 self.ui.applyButton.toolTip = "Run algorithm"
                 self.ui.applyButton.enabled = True
+                # Resolve the next subjects while the application is idle
+                qt.QTimer.singleShot(0, self._prefetchNextSubjects)
         else:  # The button must be disabled if the condition is not met
             self.ui.applyButton.toolTip = "Select the required inputs"
             self.ui.applyButton.enabled = False
             self._bool_subj = False
             # Clear the table
-            while self.ui.tableFiles.rowCount > 0:
-                self.ui.tableFiles.removeRow(0)
+            self.filesModel.setFiles([])
 
     def onConfigChange(self):
         """
         Function to update the list of inputs depending on the configuration file.
         """
-        # Load required packages, if not found, they are installed
-        try:
-            from bids import BIDSLayout
-            import yaml
-            from os.path import dirname, abspath
-        except:
+        # Check the required packages, if not found, they are installed
+        if not self.logic.packagesInstalled(["bids", "yaml"]):
             if slicer.util.confirmOkCancelDisplay(
                 "This module requires the Python packages 'pybids', and 'pyyaml'. \
                                                   Click OK to install it now."
@@ -296,9 +501,6 @@ class ImportGiftiWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                     maximum=100,
                 )
                 ImportGiftiLogic().setupPythonRequirements_basic(progressbar)
-                from bids import BIDSLayout
-                import yaml
-                from os.path import dirname, abspath
         if (
             os.path.isfile(str(self.ui.configFileSelector.currentPath))
             and self._dir_selected
@@ -308,151 +510,82 @@ class ImportGiftiWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                                                  Make sure to follow the instructions in the package documentation.",
                 waitCursor=True,
             ):
-                # Get current dir
-                current_dir = dirname(abspath(__file__))
+                import yaml
+
                 self.config = str(self.ui.configFileSelector.currentPath)
                 # Read yaml file
                 with open(self.config) as file:
                     inputs_dict = yaml.load(file, Loader=yaml.FullLoader)
+                pybids_inputs = inputs_dict["pybids_inputs"]
+                # Check all the options before applying any of them, so an invalid config file
+                # leaves the previous one in use
+                self.logic.validateOutputOptions(inputs_dict.get("output"))
+                self.logic.validateDisplayOptions(inputs_dict.get("display"))
                 data_path = str(self.ui.InputDirSelector.currentPath)
-                layout = BIDSLayout(
-                    data_path,
-                    config=self.resourcePath("Data/bids.json"),
-                    validate=False,
+                layout = self.logic.getLayout(
+                    data_path, self.resourcePath("Data/bids.json")
                 )
+                # Format of the converted files
+                self.logic.setOutputOptions(inputs_dict.get("output"))
+                # Levels of detail of the surfaces
+                self.logic.setDisplayOptions(inputs_dict.get("display"))
+                # The files of each subject are only resolved when needed
+                self._layout = layout
+                self._pybids_inputs = pybids_inputs
                 self.files = {}
-                for subj in self.list_subj:
-                    self.files[subj] = []
-                    for type_file in inputs_dict["pybids_inputs"]:
-                        input_filters = {"subject": subj}
-                        # Get pybids input filter based on the config file
-                        dict_input = inputs_dict["pybids_inputs"][type_file]
-                        # Update filter to add subject
-                        input_filters.update(dict_input["pybids_filters"])
-                        # Look for files based on BIDS
-                        image_files = layout.get(**input_filters)
-                        tmp_files = layout.get(**input_filters, return_type="filename")
-                        # Check if there are scalars attached
-                        # Case 1: gifti with scalars
-                        if "scalars" in dict_input:
-                            tmp_files_color = []
-                            for tmp_file, image_file in zip(tmp_files, image_files):
-                                labels_color = []
-                                for scalar in dict_input["scalars"]:
-                                    input_filters = {"subject": subj}
-                                    input_filters.update(
-                                        dict_input["scalars"][scalar]["pybids_filters"]
-                                    )
-                                    # Get entities from surf file
-                                    if (
-                                        "match_entities"
-                                        in dict_input["scalars"][scalar]
-                                    ):
-                                        for entity in dict_input["scalars"][scalar][
-                                            "match_entities"
-                                        ]:
-                                            input_filters[
-                                                entity
-                                            ] = image_file.get_entities()[entity]
-                                    # print(input_filters)
-                                    color_filenames = layout.get(
-                                        **input_filters, return_type="filename"
-                                    )
-                                    if "colortable" in dict_input["scalars"][scalar]:
-                                        # Update colortable path if relative
-                                        colortable_path = dict_input["scalars"][scalar][
-                                            "colortable"
-                                        ]
-                                        if not os.path.isabs(colortable_path):
-                                            colortable_path = os.path.join(
-                                                current_dir, colortable_path
-                                            )
-                                        # Update file list
-                                        labels_color += [
-                                            (
-                                                file,
-                                                colortable_path,
-                                            )
-                                            for file in color_filenames
-                                        ]
-                                    else:
-                                        labels_color += [
-                                            (file, None) for file in color_filenames
-                                        ]
-                                tmp_files_color.append((tmp_file, labels_color))
-                        # Case 2: Nifti with colortable
-                        elif "colortable" in dict_input:
-                            # Update colortable path if relative
-                            colortable_path = dict_input["colortable"]
-                            if not os.path.isabs(colortable_path):
-                                colortable_path = os.path.join(
-                                    current_dir, colortable_path
-                                )
-                            if "show_unknown" in dict_input:
-                                tmp_files_color = [
-                                    (
-                                        tmp_file,
-                                        (
-                                            colortable_path,
-                                            dict_input["show_unknown"],
-                                        ),
-                                    )
-                                    for tmp_file in tmp_files
-                                ]
-                            else:  # default to false
-                                tmp_files_color = [
-                                    (tmp_file, (colortable_path, False))
-                                    for tmp_file in tmp_files
-                                ]
-                        # Case 3: Gifti without scalars
-                        else:
-                            tmp_files_color = [(tmp_file, []) for tmp_file in tmp_files]
-                        # Add to list of files
-                        self.files[subj] += tmp_files_color
+
+    def subjectFiles(self, subj):
+        """
+        Returns the files of a subject based on the configuration file. They are resolved the
+        first time they are requested, and kept until the directory or config file change.
+        """
+        if subj not in self.files:
+            self.files.update(
+                self.logic.resolveFiles(self._layout, self._pybids_inputs, [subj])
+            )
+        return self.files[subj]
+
+    def _prefetchNextSubjects(self):
+        """
+        Resolves the files of the subjects following the selected one in the dropdown, one
+        subject per call so the GUI is not blocked.
+        """
+        if self._layout is None or self.ui.subj.currentIndex <= 0:
+            return
+        # The first item of the dropdown is not a subject
+        index = self.ui.subj.currentIndex
+        for subj in self.list_subj[index : index + self.prefetchSubjects]:
+            if subj not in self.files:
+                self.subjectFiles(subj)
+                qt.QTimer.singleShot(0, self._prefetchNextSubjects)
+                return
 
     def onVisibleAllChange(self):
         """
         Function to select all or select none files to show in the 3D view.
         """
-        if self.ui.VisibleAll.text == "Check all":
-            for chk_bx in self.checkboxes[1]:
-                chk_bx.setCheckState(qt.Qt.Checked)
-            # Change the text of the GUI
-            self.ui.VisibleAll.setText("Uncheck all")
-        elif self.ui.VisibleAll.text == "Uncheck all":
-            for chk_bx in self.checkboxes[1]:
-                chk_bx.setCheckState(qt.Qt.Unchecked)
-            # Change the text of the GUI
-            self.ui.VisibleAll.setText("Check all")
-        # Update checkboxes
-        if len(self.checkboxes[1]) > 0:
-            self.chkBoxVisibleChange()
+        self.filesModel.setAllChecked(
+            self.filesModel.VisibleColumn, self.ui.VisibleAll.text == "Check all"
+        )
+        # The model does not notify the views if the table is empty
+        self.onFilesCheckChange()
 
     def onConvertAllChange(self):
         """
         Function to select all or select none files to convert.
         """
-        if self.ui.ConvertAll.text == "Check all":
-            for chk_bx in self.checkboxes[0]:
-                chk_bx.setCheckState(qt.Qt.Checked)
-            # Change the text of the GUI
-            self.ui.ConvertAll.setText("Uncheck all")
-        elif self.ui.ConvertAll.text == "Uncheck all":
-            for chk_bx in self.checkboxes[0]:
-                chk_bx.setCheckState(qt.Qt.Unchecked)
-            # Change the text of the GUI
-            self.ui.ConvertAll.setText("Check all")
-        if len(self.checkboxes[0]) > 0:
-            self.chkBoxConvertChange()
+        self.filesModel.setAllChecked(
+            self.filesModel.ConvertColumn, self.ui.ConvertAll.text == "Check all"
+        )
+        # The model does not notify the views if the table is empty
+        self.onFilesCheckChange()
 
     def onDirectoryChange(self):
         """
         Function to update the list of files based on the input directory chosen. Also defines the state of 'Apply' button.
         """
-        # Load required packages, if not found, they are installed
-        try:
-            from bids import BIDSLayout
-        except:
+        # Check the required packages, if not found, they are installed
+        if not self.logic.packagesInstalled(["bids"]):
             if slicer.util.confirmOkCancelDisplay(
                 "This module requires the Python package 'pybids'. \
                                                   Click OK to install it now."
@@ -465,7 +598,6 @@ class ImportGiftiWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                     maximum=100,
                 )
                 ImportGiftiLogic().setupPythonRequirements_basic(progressbar)
-                from bids import BIDSLayout
         _tmp_dir_input = str(self.ui.InputDirSelector.currentPath)
 
         # Bool to change button status
@@ -474,7 +606,9 @@ class ImportGiftiWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             try:
                 # Update dropdown
                 data_path = _tmp_dir_input
-                self.BIDSLayout = BIDSLayout(data_path, validate=False)
+                self.BIDSLayout = self.logic.getLayout(
+                    data_path, self.resourcePath("Data/bids.json")
+                )
                 self.list_subj = self.BIDSLayout.get(return_type="id", target="subject")
                 self.ui.subj.clear()
                 self.ui.subj.addItems(["Select subject"] + self.list_subj)
@@ -497,47 +631,20 @@ class ImportGiftiWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             self.ui.applyButton.enabled = False
             self._dir_selected = False
 
-    def chkBoxVisibleChange(self):
+    def onFilesCheckChange(self, topLeft=None, bottomRight=None):
         """
-        Function to manage checked items in the 'Visible' column.
-        Updates the checkbox for each item as well as updating the 'All/None' checkbox.
+        Function to manage checked items in the 'Convert' and 'Visible' columns.
+        Updates the 'All/None' buttons based on the amount of files checked.
         """
-        # Look for amount of items checked
-        item_checked = 0
-        for chk_bx_conv, chk_box_vis in zip(self.checkboxes[0], self.checkboxes[1]):
-            # Visible cannot be checked if convert is unchecked.
-            if (
-                chk_box_vis.checkState() == qt.Qt.Checked
-                and chk_bx_conv.checkState() == qt.Qt.Unchecked
-            ):
-                chk_box_vis.setCheckState(qt.Qt.Unchecked)
-            elif chk_box_vis.checkState() == qt.Qt.Checked:
-                item_checked += 1
-        # Update all/none state based on the amount of files checked.
-        # If all are checked, the button should be to uncheck
-        if item_checked == len(self.checkboxes[1]):
-            self.ui.VisibleAll.setText("Uncheck all")
-        else:
-            self.ui.VisibleAll.setText("Check all")
-
-    def chkBoxConvertChange(self):
-        """
-        Function to manage checked items in the 'Convert' column.
-        Updates the checkbox for each item as well as updating the 'All/None' checkbox.
-        """
-        # Look for amount of items checked
-        item_checked = 0
-        for chk_bx in self.checkboxes[0]:
-            if chk_bx.checkState() == qt.Qt.Checked:
-                item_checked += 1
-        # Update all/none state based on the amount of files checked.
-        # If all are checked, the button should be to uncheck
-        if item_checked == len(self.checkboxes[1]):
-            self.ui.ConvertAll.setText("Uncheck all")
-        else:
-            self.ui.ConvertAll.setText("Check all")
-        # Update visible boxes
-        self.chkBoxVisibleChange()
+        for column, button in [
+            (self.filesModel.ConvertColumn, self.ui.ConvertAll),
+            (self.filesModel.VisibleColumn, self.ui.VisibleAll),
+        ]:
+            # If all are checked, the button should be to uncheck
+            if self.filesModel.allChecked(column):
+                button.setText("Uncheck all")
+            else:
+                button.setText("Check all")
 
     def updateParameterNodeFromGUI(self, caller=None, event=None):
         """
@@ -566,18 +673,49 @@ class ImportGiftiWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         Configures the behavior of 'Apply' button by connecting it to the logic function.
         """
         # Retrieve files to be converted
-        files_convert = []
-        for index, chk_bx in enumerate(self.checkboxes[0]):
-            if chk_bx.checkState() == qt.Qt.Checked:
-                files_convert.append(self.files[self.ui.subj.currentText][index])
+        subject_files = self.subjectFiles(self.ui.subj.currentText)
+        files_convert = [
+            subject_files[row]
+            for row in sorted(
+                self.filesModel.checkedRows(self.filesModel.ConvertColumn)
+            )
+        ]
         # Retrieve files to be visible
-        files_visible = []
-        for index, chk_bx in enumerate(self.checkboxes[1]):
-            if chk_bx.checkState() == qt.Qt.Checked:
-                files_visible.append(self.files[self.ui.subj.currentText][index][0])
-        ImportGiftiLogic().convertToSlicer(
-            str(self.ui.OutputDirSelector.currentPath), files_convert, files_visible
+        files_visible = {
+            subject_files[row][0]
+            for row in self.filesModel.checkedRows(self.filesModel.VisibleColumn)
+        }
+        # Run the import showing its progress. The dialog can be used to cancel it.
+        progressDialog = slicer.util.createProgressDialog(
+            parent=slicer.util.mainWindow(),
+            windowTitle="Importing files...",
+            labelText="Decoding files",
+            value=0,
+            maximum=100,
         )
+        progressDialog.connect("canceled()", self.logic.requestCancel)
+
+        def updateProgress(message, value):
+            progressDialog.labelText = message
+            progressDialog.value = value
+
+        self.logic.progressCallback = updateProgress
+        self.ui.applyButton.enabled = False
+        try:
+            failed = self.logic.convertToSlicer(
+                str(self.ui.OutputDirSelector.currentPath), files_convert, files_visible
+            )
+        finally:
+            self.logic.progressCallback = None
+            progressDialog.close()
+            self.ui.applyButton.enabled = True
+        if failed:
+            slicer.util.errorDisplay(
+                f"{len(failed)} of the selected files could not be imported.",
+                detailedText="\n".join(
+                    f"{message}: {error}" for message, error in failed
+                ),
+            )
 
 
 #########################################################################################
@@ -585,13 +723,162 @@ class ImportGiftiWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 #### ImportGiftiLogic                                                          ####
 ####                                                                                 ####
 #########################################################################################
-class ImportGiftiLogic(ScriptedLoadableModuleLogic):
-    """ """
+class ImportGiftiLogic(
+    ScriptedLoadableModuleLogic, ImportGiftiConverter, VTKObservationMixin
+):
+    """
+    Loads the files converted by ImportGiftiConverter (reading and writing files, which does not
+    need the scene) into 3D Slicer. Files are read in worker threads, then added to the scene
+    and written back in the main thread (by the functions returned by add_dseg, add_surf and
+    createClosedSurfaces), as the written meshes share their arrays with the scene nodes.
+    """
 
     def __init__(self):
         ScriptedLoadableModuleLogic.__init__(self)
-        # Create a Progress Bar
-        self.pb = qt.QProgressBar()
+        VTKObservationMixin.__init__(self)  # needed to forget the removed models
+        ImportGiftiConverter.__init__(
+            self, os.path.join(slicer.app.cachePath, "ImportGifti", "layouts")
+        )
+        # Functions to read and prepare each type of file (run in worker threads), and to add
+        # the prepared files to the scene (run in the main thread)
+        self.read_file = {".surf.gii": self.read_surf, ".nii.gz": self.read_dseg}
+        self.add_file = {".surf.gii": self.add_surf, ".nii.gz": self.add_dseg}
+        # Extension of the converted files, and functions to load them when they are up to date
+        self.output_extension = {".surf.gii": ".vtk", ".nii.gz": ".seg.nrrd"}
+        self.load_file = {".surf.gii": self.load_surf, ".nii.gz": self.load_dseg}
+        # Optional function called with a message and the progress (0-100) of convertToSlicer
+        self.progressCallback = None
+        # Set (e.g. with requestCancel) to stop convertToSlicer before the next file
+        self.cancelRequested = False
+        # Color nodes of the colortables, by colortable file version
+        self._colorNodes = {}
+        # Levels of detail mode (see setDisplayOptions): the surfaces not shown at full
+        # resolution are displayed as decimated proxies
+        self.surfaceProxies = False
+        self.proxyReduction = 0.9
+        # Surfaces imported in levels of detail mode: model node ID -> [surface file, full
+        # resolution polydata, proxy producer (None until it is needed), proxy reduction]
+        self._levelsOfDetail = {}
+        self._fullResolutionFiles = set()
+
+    def setOutputOptions(self, options):
+        """
+        Sets the format of the converted files (see ImportGiftiConverter.setOutputOptions).
+        """
+        ImportGiftiConverter.setOutputOptions(self, options)
+        self.output_extension[".surf.gii"] = self.surfaceExtension()
+
+    def setDisplayOptions(self, options):
+        """
+        Sets the display of the imported surfaces from the 'display' section of a config file:
+        surface_proxies (levels of detail mode, False by default) and proxy_reduction (fraction
+        of the triangles removed in the proxies, from 0 to 1, 0.9 by default).
+        """
+        surfaceProxies, proxyReduction = self.validateDisplayOptions(options)
+        if not surfaceProxies:
+            # Show all the surfaces at full resolution
+            self.setFullResolutionFiles(
+                [levels[0] for levels in self._levelsOfDetail.values()]
+            )
+            self.clearLevelsOfDetail()
+        self.surfaceProxies = surfaceProxies
+        self.proxyReduction = proxyReduction
+        if self._levelsOfDetail:
+            self.setFullResolutionFiles(self._fullResolutionFiles)
+
+    def validateDisplayOptions(self, options):
+        """
+        Returns surface_proxies and proxy_reduction from the 'display' section of a config file
+        (see setDisplayOptions). Raises ValueError if an option is invalid.
+        """
+        options = dict(options or {})
+        surfaceProxies = options.pop("surface_proxies", False)
+        proxyReduction = options.pop("proxy_reduction", 0.9)
+        if options:
+            raise ValueError(f"Unknown display option '{next(iter(options))}'")
+        if not isinstance(surfaceProxies, bool):
+            raise ValueError(
+                f"Invalid value '{surfaceProxies}' of display option 'surface_proxies'"
+            )
+        if (
+            isinstance(proxyReduction, bool)
+            or not isinstance(proxyReduction, (int, float))
+            or not 0 <= proxyReduction < 1
+        ):
+            raise ValueError(
+                f"Invalid value '{proxyReduction}' of display option 'proxy_reduction'"
+            )
+        return surfaceProxies, float(proxyReduction)
+
+    def addLevelsOfDetail(self, modelNode, surf):
+        """
+        Registers a model imported from a surface file in levels of detail mode (its current
+        polydata is the full resolution surface).
+        """
+        if self.surfaceProxies:
+            if not self.hasObserver(
+                slicer.mrmlScene, slicer.mrmlScene.NodeRemovedEvent, self.onNodeRemoved
+            ):
+                self.addObserver(
+                    slicer.mrmlScene,
+                    slicer.mrmlScene.NodeRemovedEvent,
+                    self.onNodeRemoved,
+                )
+            self._levelsOfDetail[modelNode.GetID()] = [
+                surf,
+                modelNode.GetPolyData(),
+                None,
+                None,
+            ]
+
+    def setFullResolutionFiles(self, files):
+        """
+        Shows the surfaces imported from the given files at full resolution, and the other
+        surfaces imported in levels of detail mode as decimated proxies (each proxy is computed
+        the first time it is shown, and again if proxyReduction changed).
+        The proxies are only set as the input of the display nodes: the model nodes keep their
+        full resolution polydata, which is the one saved with the scene or exported.
+        """
+        self._fullResolutionFiles = set(files)
+        for modelNodeID, levels in list(self._levelsOfDetail.items()):
+            surf, full, proxy, reduction = levels
+            modelNode = slicer.mrmlScene.GetNodeByID(modelNodeID)
+            if modelNode is None or modelNode.GetPolyData() is not full:
+                # The model was removed or its surface replaced
+                del self._levelsOfDetail[modelNodeID]
+                continue
+            if surf in self._fullResolutionFiles:
+                meshConnection = modelNode.GetMeshConnection()
+            else:
+                if proxy is None or reduction != self.proxyReduction:
+                    levels[2] = vtk.vtkTrivialProducer()
+                    levels[2].SetOutput(self.makeProxy(full, self.proxyReduction))
+                    levels[3] = self.proxyReduction
+                meshConnection = levels[2].GetOutputPort()
+            for index in range(modelNode.GetNumberOfDisplayNodes()):
+                displayNode = modelNode.GetNthDisplayNode(index)
+                if (
+                    isinstance(displayNode, slicer.vtkMRMLModelDisplayNode)
+                    and displayNode.GetInputMeshConnection() is not meshConnection
+                ):
+                    displayNode.SetInputMeshConnection(meshConnection)
+
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def onNodeRemoved(self, caller, event, node):
+        """
+        Forgets the levels of detail of a removed model (so its polydata can be released).
+        """
+        self._levelsOfDetail.pop(node.GetID(), None)
+
+    def clearLevelsOfDetail(self):
+        """
+        Forgets the levels of detail of the imported surfaces (e.g. when the scene is closed).
+        """
+        self.removeObserver(
+            slicer.mrmlScene, slicer.mrmlScene.NodeRemovedEvent, self.onNodeRemoved
+        )
+        self._levelsOfDetail = {}
+        self._fullResolutionFiles = set()
 
     def setDefaultParameters(self, parameterNode):
         """
@@ -600,10 +887,23 @@ class ImportGiftiLogic(ScriptedLoadableModuleLogic):
         if not parameterNode.GetParameter("LUT"):
             parameterNode.SetParameter("LUT", "Select LUT file")
 
-    def convertToSlicer(self, OutputPath, files_convert, files_visible):
+    def convertToSlicer(
+        self,
+        OutputPath,
+        files_convert,
+        files_visible,
+        writeSegmentations=True,
+        reuseOutputs=True,
+    ):
         """
         Takes the files, convert them into an Slicer compatible format, saves them and loads them into 3D Slicer.
+        Segmentations are only saved to OutputPath if writeSegmentations is set.
+        The converted files are recorded in a manifest in OutputPath. If reuseOutputs is set, files
+        already converted from the same (unchanged) sources are loaded instead of converted again.
+        files_visible can be any collection of paths (it is looked up as a set).
+        Returns the files that failed, as a list of (message, exception).
         """
+        files_visible = set(files_visible)
         # Load required packages, if not found, they are installed
         try:
             import pandas as pd
@@ -646,322 +946,433 @@ class ImportGiftiLogic(ScriptedLoadableModuleLogic):
         if OutputPath == ".":
             OutputPath = os.getcwd()
 
-        # For each type of file, run the corresponding function
-        for extension in files_dict:
-            if extension == ".surf.gii":
-                with slicer.util.tryWithErrorDisplay(
-                    "Failed to convert surface file",
-                    waitCursor=True,
-                ):
-                    self.convert_surf(files_dict[extension], OutputPath, files_visible)
-            elif extension == ".nii.gz":
-                with slicer.util.tryWithErrorDisplay(
-                    "Failed to convert segmentation file",
-                    waitCursor=True,
-                ):
-                    self.convert_dseg(files_dict[extension], OutputPath, files_visible)
-            else:
+        # Decode all the files in parallel in worker threads (reading and preparing the arrays is
+        # independent for each file). Each file is added to the scene in the main thread when it
+        # is decoded, and its output is then written back in the main thread. The scene is in
+        # batch processing state meanwhile, so the progress is reported for each file but the
+        # views only show the new nodes once, at the end of the import.
+        # Files already converted from the same sources are only loaded
+        manifest = self.readManifest(OutputPath)
+        jobs = []
+        loads = []
+        for extension, files in files_dict.items():
+            if extension not in self.read_file:
                 print(f"File type {extension} is not supported.")
+                continue
+            for file in files:
+                out_file = self.outputFile(
+                    file[0], OutputPath, self.output_extension[extension]
+                )
+                record = self.conversionRecord(file)
+                entry = self.upToDate(manifest, OutputPath, out_file, record)
+                if reuseOutputs and entry is not None:
+                    loads.append((extension, file, entry))
+                else:
+                    jobs.append((extension, file, out_file, record))
+        self.cancelRequested = False
+        # Scalar files are decoded once per import
+        self.clearScalarCache()
+        # decode, add to scene and write each file, or load it. A file that fails is reported
+        # at the end and does not stop the import of the others.
+        steps = 3 * len(jobs) + len(loads)
+        step = 0
+        failed = []
+        written = False
+        try:
+            with self.batchSceneUpdates(), concurrent.futures.ThreadPoolExecutor() as executor:
+                decoding = {
+                    executor.submit(self.read_file[job[0]], job[1]): job for job in jobs
+                }
+                # Up to date files are loaded while the other files are decoded
+                for extension, file, entry in loads:
+                    if self.cancelRequested:
+                        break
+                    filename = os.path.basename(file[0])
+                    try:
+                        self.load_file[extension](
+                            file, entry, OutputPath, files_visible
+                        )
+                    except Exception as error:
+                        failed.append((f"Failed to load {filename}", error))
+                        print(f"Failed to load {file[0]}: {error}")
+                    step += 1
+                    self._reportProgress(f"Loaded {filename}", step, steps)
+                    slicer.app.processEvents()
+                for future in self._waitForResults(decoding):
+                    extension, file, out_file, record = decoding[future]
+                    filename = os.path.basename(file[0])
+                    step += 1
+                    self._reportProgress(f"Decoded {filename}", step, steps)
+                    write = None
+                    try:
+                        self._reportProgress(f"Building {filename}", step, steps)
+                        result = future.result()
+                        write = self.add_file[extension](
+                            file, result, OutputPath, files_visible
+                        )
+                        if extension == ".surf.gii":
+                            # Display settings needed to load the output later
+                            record["display"] = self.surfaceDisplay(result)
+                    except Exception as error:
+                        failed.append((f"Failed to convert {filename}", error))
+                        print(f"Failed to convert {file[0]}: {error}")
+                    step += 1
+                    self._reportProgress(f"Added {filename} to the scene", step, steps)
+                    # The output shares its arrays with the new nodes, so it is written here
+                    # rather than in a worker thread
+                    if write is not None and (
+                        extension != ".nii.gz" or writeSegmentations
+                    ):
+                        try:
+                            write()
+                            manifest[os.path.relpath(out_file, OutputPath)] = record
+                            written = True
+                        except Exception as error:
+                            failed.append((f"Failed to write {filename}", error))
+                            print(f"Failed to write {out_file}: {error}")
+                    step += 1
+                    self._reportProgress(f"Wrote {filename}", step, steps)
+                if self.surfaceProxies:
+                    # The surfaces imported before are shown as proxies
+                    self.setFullResolutionFiles([file for file, _ in files_convert])
+                if self.cancelRequested:
+                    # Files that were not started are skipped
+                    for future in decoding:
+                        future.cancel()
+                    self._reportProgress("Import cancelled", steps, steps)
+                else:
+                    self._reportProgress("Import finished", steps, steps)
+        finally:
+            # The outputs written so far are recorded even if the import was interrupted
+            if written:
+                self.writeManifest(OutputPath, manifest)
+        return failed
+
+    @contextlib.contextmanager
+    def batchSceneUpdates(self):
+        """
+        Context in which nodes are added to the scene in batch processing state and rendering
+        is paused. The views are updated once at the end (when rendering is resumed) instead of
+        after each node.
+        """
+        with slicer.util.RenderBlocker():
+            slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
+            try:
+                yield
+            finally:
+                slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
 
-    def convert_dseg(self, dseg_files, OutputPath, files_visible):
+    def requestCancel(self):
         """
-        Converts nifti files to seg.nrrd and loads them into 3D Slicer.
+        Stops convertToSlicer after the files currently being processed.
         """
-        import pandas as pd
-        import nibabel as nb
-        from pathlib import Path
-
-        for dseg, (colortable, show_unknown) in dseg_files:
-            # Read colortable
-            atlas_labels = pd.read_table(colortable)
-            atlas_labels["lut"] = atlas_labels[["r", "g", "b"]].to_numpy().tolist()
-            # Find base file name to create output
-            filename_with_extension = os.path.basename(dseg)
-            base_filename = filename_with_extension.split(".", 1)[0]
-            # Find parent dir
-            path = Path(dseg)
-            parent_dir = os.path.join(path.parents[1].name, path.parents[0].name)
-            # Create sub and anat folder if it doesn't exist
-            if not os.path.exists(os.path.join(OutputPath, parent_dir)):
-                os.makedirs(os.path.join(OutputPath, parent_dir))
-            seg_out_fname = os.path.join(
-                OutputPath, parent_dir, f"{base_filename}.seg.nrrd"
+        self.cancelRequested = True
+
+    def _reportProgress(self, message, step, steps):
+        """
+        Reports the progress of convertToSlicer to progressCallback (if set).
+        """
+        if self.progressCallback is not None:
+            self.progressCallback(message, int(100 * step / steps) if steps else 100)
+
+    def _waitForResults(self, futures):
+        """
+        Yields the futures as they are completed. Application events are processed while waiting,
+        so the GUI stays responsive, and it stops yielding if cancelRequested is set.
+        """
+        pending = set(futures)
+        while pending and not self.cancelRequested:
+            done, pending = concurrent.futures.wait(
+                pending, timeout=0.1, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                yield future
+                if self.cancelRequested:
+                    return
+            slicer.app.processEvents()
+
+    def add_dseg(self, dseg_file, seg, OutputPath, files_visible):
+        """
+        Loads a segmentation prepared with read_dseg into 3D Slicer. Returns a function that
+        saves it as seg.nrrd in OutputPath.
+        """
+        dseg, _ = dseg_file
+        # Find base file name to create output
+        filename_with_extension = os.path.basename(dseg)
+        base_filename = filename_with_extension.split(".", 1)[0]
+        # Create the segmentation
+        segmentationNode = self.load_segmentation(seg, base_filename)
+        seg_out_fname = self.outputFile(
+            dseg, OutputPath, self.output_extension[".nii.gz"]
+        )
+        writeClosedSurfaces = None
+        if dseg in files_visible:
+            writeClosedSurfaces = self.createClosedSurfaces(
+                segmentationNode, dseg_file, seg_out_fname
             )
-            # Load data from dseg file
-            data_obj = nb.load(dseg)
+
+        def write():
+            # Create sub and anat folder if it doesn't exist
+            os.makedirs(os.path.dirname(seg_out_fname), exist_ok=True)
             # Convert to nrrd
-            self.write_nrrd(data_obj, seg_out_fname, atlas_labels, show_unknown)
-            seg = slicer.util.loadSegmentation(seg_out_fname)
-            if dseg in files_visible:
-                seg.CreateClosedSurfaceRepresentation()
+            self.write_nrrd(seg, seg_out_fname)
+            if writeClosedSurfaces is not None:
+                writeClosedSurfaces()
 
-    def convert_surf(self, surf_files, OutputPath, files_visible):
+        return write
+
+    def load_dseg(self, dseg_file, entry, OutputPath, files_visible):
         """
-        Converts gifti files to vtk and loads them into 3D Slicer.
+        Loads a segmentation already converted to seg.nrrd in OutputPath (entry is its record
+        in the manifest).
         """
-        import pandas as pd
-        import nibabel as nb
-        from nibabel.affines import apply_affine
-
-        for surf, label_files in surf_files:
-            # Build the name of the output file
-            # Find base file name to create output
-            filename_with_extension = os.path.basename(surf)
-            base_filename = filename_with_extension.split(".", 1)[0]
-            # Find parent dir
-            path = Path(surf)
-            parent_dir = os.path.join(path.parents[1].name, path.parents[0].name)
-            # Create surf folder if it doesn't exist
-            if not os.path.exists(os.path.join(OutputPath, parent_dir)):
-                os.makedirs(os.path.join(OutputPath, parent_dir))
-            # Output file name
-            outFilePath = os.path.join(OutputPath, parent_dir, f"{base_filename}.vtk")
-            # Extract geometric data
-            gii_data = nb.load(surf)
-            vertices = gii_data.get_arrays_from_intent("NIFTI_INTENT_POINTSET")[0].data
-            faces = gii_data.get_arrays_from_intent("NIFTI_INTENT_TRIANGLE")[0].data
-            # Extract color data and add scalars
-            arrayScalars = []
-            labelsScalars = []
-            active_scalar = None
-            scalar_range = []
-            if len(label_files) > 0:
-                label_files_df = pd.DataFrame(label_files)
-                # Iterate over the different files with scalars
-                for index in label_files_df.index:
-                    vert_colors_idx = nb.load(label_files_df.loc[index, 0]).agg_data()
-                    name_label = (
-                        os.path.basename(label_files_df.loc[index, 0])
-                        .split(".", 1)[0]
-                        .split("-")[-1]
-                    )
-                    # Case 1: Scalar + colortable
-                    # Extract colors from df if a colortable was given
-                    if label_files_df.loc[index, 1] != None:
-                        df_colors = pd.read_table(
-                            label_files_df.loc[index, 1], index_col="index"
-                        )
-                        # Create color table in Slicer
-                        colorTableNode = slicer.mrmlScene.AddNewNodeByClass(
-                            "vtkMRMLProceduralColorNode", "HippUnfoldColors"
-                        )
-                        colorTableNode.SetType(slicer.vtkMRMLColorTableNode.User)
-                        colorTransferFunction = (
-                            vtk.vtkDiscretizableColorTransferFunction()
-                        )
-                        for index_color in df_colors.index:
-                            r = df_colors.loc[index_color, "r"] / 255.0
-                            g = df_colors.loc[index_color, "g"] / 255.0
-                            b = df_colors.loc[index_color, "b"] / 255.0
-                            colorTransferFunction.AddRGBPoint(index_color, r, g, b)
-                        colorTableNode.SetAndObserveColorTransferFunction(
-                            colorTransferFunction
-                        )
-                        # Append scalars into the list of scalars
-                        if len(arrayScalars) == 0:
-                            arrayScalars = [
-                                tuple([scalar]) for scalar in vert_colors_idx
-                            ]
-                        else:
-                            for idx in range(len(vert_colors_idx)):
-                                arrayScalars[idx] += tuple([vert_colors_idx[idx]])
-                        # Append the name of the scalar into the list of names
-                        labelsScalars.append(name_label)
-                        # Set any scalar with colortable as the active scalar
-                        active_scalar = name_label
-                        # Extract the range of the active scalar
-                        indexes = df_colors.index.values.tolist()
-                        scalar_range = (indexes[0], indexes[-1])
-                    # Case 2: Scalar without colotable.
-                    else:
-                        # Append scalars into the list of scalars
-                        if len(arrayScalars) == 0:
-                            arrayScalars = [
-                                tuple([scalar]) for scalar in vert_colors_idx
-                            ]
-                        else:
-                            for idx in range(len(vert_colors_idx)):
-                                arrayScalars[idx] += tuple([vert_colors_idx[idx]])
-                        # Append the name of the scalar into the list of names
-                        labelsScalars.append(name_label)
-                        # Set as active scalar only if there's no defined active scalar and this is the last scalar file
-                        if (
-                            active_scalar == None
-                            and index == list(label_files_df.index)[-1]
-                        ):
-                            active_scalar = name_label
-            # Create model
-            surf_pv = self.makePolyData(vertices, faces, labelsScalars, arrayScalars)
-            modelNode = slicer.modules.models.logic().AddModel(surf_pv)
-            # Set name
-            modelNode.SetName(base_filename)
-            # Set active scalar
-            # Case 1: scalar + colortable
-            if len(scalar_range) > 0 and active_scalar != None:
-                modelNode.GetDisplayNode().SetActiveScalar(
-                    active_scalar, vtk.vtkAssignAttribute.POINT_DATA
-                )
-                modelNode.GetDisplayNode().SetAndObserveColorNodeID(
-                    colorTableNode.GetID()
-                )
-                modelNode.GetDisplayNode().SetAutoScalarRange(False)
-                modelNode.GetDisplayNode().SetScalarRange(
-                    scalar_range[0], scalar_range[1]
+        dseg, _ = dseg_file
+        seg_file = self.outputFile(dseg, OutputPath, self.output_extension[".nii.gz"])
+        segmentationNode = slicer.util.loadSegmentation(seg_file)
+        if dseg in files_visible:
+            writeClosedSurfaces = self.createClosedSurfaces(
+                segmentationNode, dseg_file, seg_file
+            )
+            if writeClosedSurfaces is not None:
+                writeClosedSurfaces()
+        return segmentationNode
+
+    def createClosedSurfaces(self, segmentationNode, dseg_file, seg_file):
+        """
+        Creates the closed surface representation of a segmentation with the parameters of its
+        input (see closedSurfaceParameters). The surfaces are restored from the cache next to
+        its seg.nrrd (seg_file) if they were generated from the same sources and parameters.
+        Otherwise they are generated, and a function that saves them in the cache is returned.
+        """
+        _, inputs = dseg_file
+        params = inputs[2] if len(inputs) > 2 else self.closedSurfaceParameters()
+        key = self.closedSurfaceKey(dseg_file)
+        cacheFile = self.closedSurfaceFile(seg_file)
+        segmentation = segmentationNode.GetSegmentation()
+        for option, value in params.items():
+            segmentation.SetConversionParameter(
+                CLOSED_SURFACE_OPTIONS[option][0], str(value)
+            )
+        closedSurfaceName = (
+            slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+        )
+        segments = [
+            segmentation.GetNthSegment(index)
+            for index in range(segmentation.GetNumberOfSegments())
+        ]
+        surfaces = self.read_closed_surfaces(cacheFile, key)
+        if surfaces is not None and all(
+            segment.GetLabelValue() in surfaces for segment in segments
+        ):
+            for segment in segments:
+                segment.AddRepresentation(
+                    closedSurfaceName, surfaces[segment.GetLabelValue()]
                 )
-                modelNode.GetDisplayNode().SetScalarVisibility(True)
-            elif active_scalar != None:
-                modelNode.GetDisplayNode().SetActiveScalar(
-                    active_scalar, vtk.vtkAssignAttribute.POINT_DATA
+            write = None
+        else:
+            segmentationNode.CreateClosedSurfaceRepresentation()
+            surfaces = {}
+            for segment in segments:
+                surfaces[segment.GetLabelValue()] = vtk.vtkPolyData()
+                surfaces[segment.GetLabelValue()].ShallowCopy(
+                    segment.GetRepresentation(closedSurfaceName)
                 )
-                modelNode.GetDisplayNode().SetAutoScalarRange(True)
-                modelNode.GetDisplayNode().SetScalarVisibility(True)
-            # Set visibility
-            if surf in files_visible:
-                modelNode.SetDisplayVisibility(True)
-            else:
-                modelNode.SetDisplayVisibility(False)
-            # Export model (needs to be recomputed as the vertices needs to be rotated)
-            # Transform vertices
-            LPS_to_RAS = np.array(
-                [[-1, 0, 0, 0], [0, -1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]]
+
+            def write():
+                self.write_closed_surfaces(surfaces, cacheFile, key)
+
+        segmentationNode.GetDisplayNode().SetPreferredDisplayRepresentationName3D(
+            closedSurfaceName
+        )
+        return write
+
+    def convert_dseg(self, dseg_files, OutputPath, files_visible, writeOutput=True):
+        """
+        Converts nifti files to segmentations, loads them into 3D Slicer and, if writeOutput
+        is set, saves them as seg.nrrd.
+        """
+        for dseg_file in dseg_files:
+            write = self.add_dseg(
+                dseg_file, self.read_dseg(dseg_file), OutputPath, files_visible
             )
-            vertices = apply_affine(LPS_to_RAS, vertices)
-            # Recompute surface and write
-            surf_pv = self.makePolyData(vertices, faces, labelsScalars, arrayScalars)
-            writer = vtk.vtkPolyDataWriter()
-            writer.SetInputData(surf_pv)
-            writer.SetFileName(outFilePath)
-            writer.Write()
+            if writeOutput:
+                write()
+
+    def add_surf(self, surf_file, surface, OutputPath, files_visible):
+        """
+        Loads a surface prepared with read_surf into 3D Slicer. Returns a function that saves
+        it as vtk or vtp in OutputPath.
+        """
+        surf, _ = surf_file
+        # Build the name of the output file
+        # Find base file name to create output
+        filename_with_extension = os.path.basename(surf)
+        base_filename = filename_with_extension.split(".", 1)[0]
+        # Output file name
+        outFilePath = self.outputFile(
+            surf, OutputPath, self.output_extension[".surf.gii"]
+        )
+        vertices = surface["vertices"]
+        # Create model (the triangles are shared with the surfaces of the same topology)
+        cells = self.sharedCells(surface["faces"], surface["faces_key"])
+        # Scalar files attached to several surfaces share one array
+        scalars = {
+            name: self.sharedScalarArray(surface["scalar_files"][name], name, values)
+            for name, values in surface["scalars"].items()
+        }
+        surf_pv = self.makePolyData(vertices, cells, scalars)
+        modelNode = slicer.modules.models.logic().AddModel(surf_pv)
+        # Set name
+        modelNode.SetName(base_filename)
+        self.setSurfaceDisplay(
+            modelNode, self.surfaceDisplay(surface), surf in files_visible
+        )
+        self.addLevelsOfDetail(modelNode, surf)
+        # Export model. Only the vertices need to be rotated (RAS -> LPS), so the exported
+        # mesh shares the cells and the scalars with the model.
+        LPS_to_RAS = np.array([-1, -1, 1], dtype=np.float32)
+        surf_lps = vtk.vtkPolyData()
+        surf_lps.ShallowCopy(surf_pv)
+        surf_lps.SetPoints(self.makePoints(vertices * LPS_to_RAS))
 
-    # Functions to compute files
-    def bounding_box(self, seg):
+        def write():
+            self.write_surf(surf_lps, outFilePath)
+
+        return write
+
+    def load_surf(self, surf_file, entry, OutputPath, files_visible):
         """
-        Defines bounding box around volumetric object
+        Loads a surface already converted to vtk/vtp in OutputPath, with the display settings
+        recorded in its manifest entry.
         """
-        x = np.any(np.any(seg, axis=0), axis=1)
-        y = np.any(np.any(seg, axis=1), axis=1)
-        z = np.any(np.any(seg, axis=1), axis=0)
-        ymin, ymax = np.where(y)[0][[0, -1]]
-        xmin, xmax = np.where(x)[0][[0, -1]]
-        zmin, zmax = np.where(z)[0][[0, -1]]
-        bbox = np.array([ymin, ymax, xmin, xmax, zmin, zmax])
-        return bbox
+        surf, _ = surf_file
+        modelNode = slicer.util.loadModel(
+            self.outputFile(surf, OutputPath, self.output_extension[".surf.gii"])
+        )
+        self.setSurfaceDisplay(modelNode, entry["display"], surf in files_visible)
+        self.addLevelsOfDetail(modelNode, surf)
+        return modelNode
+
+    def setSurfaceDisplay(self, modelNode, display, visible):
+        """
+        Sets the active scalar, colors and visibility of a model (display is a dictionary built
+        with surfaceDisplay).
+        """
+        active_scalar = display["active_scalar"]
+        scalar_range = display["scalar_range"]
+        # Get color table in Slicer (shared by all the models using the same colortable)
+        if display["colortable"] is not None:
+            colorTableNode = self.getColorNode(display["colortable"])
+        displayNode = modelNode.GetDisplayNode()
+        # All the display changes are notified with a single modified event
+        wasModified = displayNode.StartModify()
+        # Set active scalar
+        # Case 1: scalar + colortable
+        if len(scalar_range) > 0 and active_scalar != None:
+            displayNode.SetActiveScalar(
+                active_scalar, vtk.vtkAssignAttribute.POINT_DATA
+            )
+            displayNode.SetAndObserveColorNodeID(colorTableNode.GetID())
+            displayNode.SetAutoScalarRange(False)
+            displayNode.SetScalarRange(scalar_range[0], scalar_range[1])
+            displayNode.SetScalarVisibility(True)
+        elif active_scalar != None:
+            displayNode.SetActiveScalar(
+                active_scalar, vtk.vtkAssignAttribute.POINT_DATA
+            )
+            displayNode.SetAutoScalarRange(True)
+            displayNode.SetScalarVisibility(True)
+        # Set visibility
+        if visible:
+            modelNode.SetDisplayVisibility(True)
+        else:
+            modelNode.SetDisplayVisibility(False)
+        displayNode.EndModify(wasModified)
 
-    def get_shape_origin(self, img_data):
+    def convert_surf(self, surf_files, OutputPath, files_visible):
         """
-        Get shape of the volumetric data and defines the origin in one of its corners.
+        Converts gifti files to vtk and loads them into 3D Slicer. In levels of detail mode
+        (see setDisplayOptions), these surfaces are shown at full resolution and the ones
+        imported before as decimated proxies.
         """
-        bbox = self.bounding_box(img_data)
-        ymin, ymax, xmin, xmax, zmin, zmax = bbox
-        shape = list(np.array([ymax - ymin, xmax - xmin, zmax - zmin]) + 1)
-        origin = [ymin, xmin, zmin]
-        return shape, origin
+        for surf_file in surf_files:
+            write = self.add_surf(
+                surf_file, self.read_surf(surf_file), OutputPath, files_visible
+            )
+            write()
+        if self.surfaceProxies:
+            self.setFullResolutionFiles([surf for surf, _ in surf_files])
 
-    def write_nrrd(self, data_obj, out_file, atlas_labels, show_unknown):
+    def getColorNode(self, colortable):
         """
-        Writes nrrd file based on a nifti object.
+        Returns the color node of a colortable, creating it the first time. The node is shared by
+        all the models that use the same colortable.
         """
-        import nibabel as nb
-        import nrrd
+        key = self._colortableKey(colortable)
+        name = os.path.basename(colortable).split(".", 1)[0]
+        colorTableNode = slicer.mrmlScene.GetNodeByID(self._colorNodes.get(key, ""))
+        # The ID may have been given to another node if the color node was removed
+        if (
+            colorTableNode is None
+            or not colorTableNode.IsA("vtkMRMLProceduralColorNode")
+            or colorTableNode.GetName() != name
+        ):
+            lookup = self.getColortable(colortable)
+            colorTableNode = slicer.mrmlScene.AddNewNodeByClass(
+                "vtkMRMLProceduralColorNode", name
+            )
+            colorTableNode.SetType(slicer.vtkMRMLColorTableNode.User)
+            # Fill all the points (index, r, g, b) of the transfer function at once
+            colorTransferFunction = vtk.vtkDiscretizableColorTransferFunction()
+            points = np.column_stack([lookup["index"], lookup["color"][:, :3]])
+            colorTransferFunction.FillFromDataPointer(len(points), points.ravel())
+            colorTableNode.SetAndObserveColorTransferFunction(colorTransferFunction)
+            self._colorNodes[key] = colorTableNode.GetID()
+        return colorTableNode
 
-        # Get data from the nifti
-        data = data_obj.get_fdata()
-
-        # Define some parameters for the nrrd
-        keyvaluepairs = {}
-        keyvaluepairs["dimension"] = 3
-        keyvaluepairs["encoding"] = "gzip"
-        keyvaluepairs["kinds"] = ["domain", "domain", "domain"]
-        keyvaluepairs["space"] = "right-anterior-superior"
-        keyvaluepairs["space directions"] = data_obj.affine[:3, :3].T
-        keyvaluepairs["type"] = "double"
-
-        # Get bounding box, shape and origin of the object.
-        box = self.bounding_box(data)
-        seg_cut = data[box[0] : box[1] + 1, box[2] : box[3] + 1, box[4] : box[5] + 1]
-        shape, origin = self.get_shape_origin(data)
-        origin = nb.affines.apply_affine(data_obj.affine, np.array([origin]))
-
-        keyvaluepairs["sizes"] = np.array([*shape])
-        keyvaluepairs["space origin"] = origin[0]
-        i = 0  # Count segments
-        # Set parameters for each different label in the nifti object
-        for id in range(int(np.min(data)), int(np.max(data)) + 1):
-            if id in atlas_labels["index"].tolist() or show_unknown:
-                name = "Segment{}".format(i)
-                # Define colors and name in an atlas was given
-                if id in atlas_labels["index"].tolist():
-                    col_lut = (
-                        np.array(
-                            atlas_labels[atlas_labels["index"] == id]["lut"].values[0]
-                            + [255]
-                        )
-                        / 255
-                    )
-                    keyvaluepairs[name + "_Name"] = atlas_labels[
-                        atlas_labels["index"] == id
-                    ]["abbreviation"].values[0]
-                    keyvaluepairs[name + "_Color"] = " ".join(
-                        [f"{a:10.3f}" for a in col_lut]
-                    )
-                else:  # unknown region
-                    col_lut = np.array([0, 0, 0, 0])
-                    keyvaluepairs[name + "_Name"] = "Unknown"
-                    keyvaluepairs[name + "_Color"] = " ".join(
-                        [f"{a:10.3f}" for a in col_lut]
-                    )
-                keyvaluepairs[name + "_ColorAutoGenerated"] = "1"
-                keyvaluepairs[
-                    name + "_Extent"
-                ] = f"0 {shape[0]-1} 0 {shape[1]-1} 0 {shape[2]-1}"
-                keyvaluepairs[name + "_ID"] = "Segment_{}".format(id)
-                keyvaluepairs[name + "_LabelValue"] = "{}".format(id)
-                keyvaluepairs[name + "_Layer"] = "0"
-                keyvaluepairs[name + "_NameAutoGenerated"] = 1
-                keyvaluepairs[name + "_Tags"] = (
-                    "TerminologyEntry:Segmentation category"
-                    + " and type - 3D Slicer General Anatomy list~SRT^T-D0050^Tissue~SRT^"
-                    + "T-D0050^Tissue~^^~Anatomic codes - DICOM master list~^^~^^|"
-                )
-                i += 1
-        keyvaluepairs["Segmentation_ContainedRepresentationNames"] = "Binary labelmap|"
-        keyvaluepairs["Segmentation_ConversionParameters"] = "placeholder"
-        keyvaluepairs["Segmentation_MasterRepresentation"] = "Binary labelmap"
-
-        nrrd.write(out_file, seg_cut, keyvaluepairs)
-
-    # Function to create vtkPolyData object
-    def makePolyData(self, verts, faces, labelsScalars, arrayScalars):
-        """
-        Create vtkPolyData based on vertices, faces and scalars. Recovered from:
-        https://github.com/stephan1312/SlicerEAMapReader/blob/2798100fe2aebf482a83b347c1cef18135f2df87/EAMapReader-Slicer-4.11/lib/Slicer-4.11/qt-scripted-modules/EAMapReader.py#L218-L290
-        https://programtalk.com/python-examples/vtk.vtkPolyData/
-        """
-        # Build structure
-        mesh = vtk.vtkPolyData()
-        pts = vtk.vtkPoints()
-        for pt in verts:
-            pts.InsertNextPoint(pt[0], pt[1], pt[2])
-        cells = vtk.vtkCellArray()
-        for f in faces:
-            cells.InsertNextCell(len(f))
-            for v in f:
-                cells.InsertCellPoint(v)
-        mesh.SetPoints(pts)
-        mesh.SetPolys(cells)
-
-        # Add scalars
-        scalars = []
-        for j in range(len(labelsScalars)):
-            scalars.append(vtk.vtkFloatArray())
-            scalars[j].SetNumberOfComponents(1)
-            scalars[j].SetNumberOfTuples(len(arrayScalars))
-            for i in range(len(arrayScalars)):
-                scalars[j].SetTuple1(i, arrayScalars[i][j])
-            scalars[j].SetName(labelsScalars[j])
-            mesh.GetPointData().AddArray(scalars[j])
-
-        return mesh
+    def clearColorNodes(self):
+        """
+        Forgets the color nodes of the colortables (e.g. when the scene is closed).
+        """
+        self._colorNodes = {}
+
+    def load_segmentation(self, seg, name):
+        """
+        Creates a segmentation node directly from a segmentation prepared with prepare_dseg
+        (without writing and reading back a file). The segments share one labelmap and have the
+        IDs, label values, names and colors of the seg.nrrd header, as when it is loaded.
+        """
+        labelmapNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+        # Slicer arrays are indexed KJI
+        slicer.util.updateVolumeFromArray(labelmapNode, seg["data"].transpose())
+        labelmapNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(seg["ijkToRAS"]))
+        labelmap = slicer.vtkSlicerSegmentationsModuleLogic.CreateOrientedImageDataFromVolumeNode(
+            labelmapNode
+        )
+        slicer.mrmlScene.RemoveNode(labelmapNode)
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass(
+            "vtkMRMLSegmentationNode", name
+        )
+        segmentationNode.CreateDefaultDisplayNodes()
+        segmentation = segmentationNode.GetSegmentation()
+        binaryLabelmapName = (
+            slicer.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName()
+        )
+        # One segment per label of the header (labels not shown have no segment)
+        for label, segment_name, color in seg["segments"]:
+            segment = slicer.vtkSegment()
+            segment.SetName(segment_name)
+            segment.SetColor(color[:3])
+            segment.SetLabelValue(label)
+            segment.AddRepresentation(binaryLabelmapName, labelmap)
+            segmentation.AddSegment(segment, f"Segment_{label}")
+        return segmentationNode
+
+    def packagesInstalled(self, modules):
+        """
+        Returns whether the given Python modules are installed (without importing them).
+        """
+        return all(importlib.util.find_spec(module) is not None for module in modules)
 
     def setupPythonRequirements_basic(self, progressDialog):
         """
@@ -1048,6 +1459,33 @@ class ImportGiftiTest(ScriptedLoadableModuleTest):
         self.setUp()
         # Test load multiple files (dseg + surf + invalid)
         self.test_ImportGifti_multiple()
+        self.setUp()
+        # Test load files already converted (from the manifest)
+        self.test_ImportGifti_reuse()
+        self.setUp()
+        # Test closed surfaces restored from their cache
+        self.test_ImportGifti_closed_surface_cache()
+        self.setUp()
+        # Test surfaces shown as decimated proxies
+        self.test_ImportGifti_levels_of_detail()
+        self.setUp()
+        # Test the model of the files table
+        self.test_ImportGifti_files_model()
+        self.setUp()
+        # Test the gifti reader against nibabel
+        self.test_ImportGifti_gifti_reader()
+        self.setUp()
+        # Test the files written in each output format
+        self.test_ImportGifti_output_formats()
+        self.setUp()
+        # Test a segmentation without labels
+        self.test_ImportGifti_empty_dseg()
+        self.setUp()
+        # Test the type of the labels written to seg.nrrd
+        self.test_ImportGifti_dseg_type()
+        self.setUp()
+        # Test the segments of the labels found in the colortable or not
+        self.test_ImportGifti_dseg_labels()
 
     def test_ImportGifti_dseg(self):
         """
@@ -1061,8 +1499,6 @@ class ImportGiftiTest(ScriptedLoadableModuleTest):
         # Load MRHead Sample Data
         sampleDataLogic = SampleData.SampleDataLogic()
         sampleDataLogic.downloadSample("MRHead")
-        # Output dir
-        out_dir = tempfile.gettempdir()
         # dseg, (colortable, show_unknown)
         # Build files_convert
         current_dir = dirname(abspath(__file__))
@@ -1098,7 +1534,23 @@ class ImportGiftiTest(ScriptedLoadableModuleTest):
             unknown = False
         # Ony set to visible the second file
         files_visible = [tmp_files[-1]]
-        ImportGiftiLogic().convertToSlicer(str(out_dir), files_convert, files_visible)
+        # Empty output dir, so the files are converted and not loaded from a previous run
+        with tempfile.TemporaryDirectory() as out_dir:
+            logic = ImportGiftiLogic()
+            self.assertEqual(
+                logic.convertToSlicer(out_dir, files_convert, files_visible), []
+            )
+            self.assertEqual(len(logic.readManifest(out_dir)), len(files_convert))
+            # The closed surfaces of the visible file were generated and cached
+            seg_file = logic.outputFile(
+                tmp_files[-1], out_dir, logic.output_extension[".nii.gz"]
+            )
+            self.assertIsNotNone(
+                logic.read_closed_surfaces(
+                    logic.closedSurfaceFile(seg_file),
+                    logic.closedSurfaceKey(files_convert[-1]),
+                )
+            )
 
         self.delayDisplay("dseg test passed!")
 
@@ -1114,8 +1566,6 @@ class ImportGiftiTest(ScriptedLoadableModuleTest):
         # Load MRHead Sample Data
         sampleDataLogic = SampleData.SampleDataLogic()
         sampleDataLogic.downloadSample("MRHead")
-        # Output dir
-        out_dir = tempfile.gettempdir()
         # (tmp_file, labels_color)
         # labels_color = [(file, dict_input['scalars'][scalar]['colortable']) for file in color_filenames]
         current_dir = dirname(abspath(__file__))
@@ -1161,7 +1611,13 @@ class ImportGiftiTest(ScriptedLoadableModuleTest):
         files_convert.append((tmp_files[1], []))
         # Ony set to visible the first file
         files_visible = [tmp_files[0]]
-        ImportGiftiLogic().convertToSlicer(str(out_dir), files_convert, files_visible)
+        # Empty output dir, so the files are converted and not loaded from a previous run
+        with tempfile.TemporaryDirectory() as out_dir:
+            logic = ImportGiftiLogic()
+            self.assertEqual(
+                logic.convertToSlicer(out_dir, files_convert, files_visible), []
+            )
+            self.assertEqual(len(logic.readManifest(out_dir)), len(files_convert))
 
         self.delayDisplay("surf test passed!")
 
@@ -1177,8 +1633,6 @@ class ImportGiftiTest(ScriptedLoadableModuleTest):
         # Load MRHead Sample Data
         sampleDataLogic = SampleData.SampleDataLogic()
         sampleDataLogic.downloadSample("MRHead")
-        # Output dir
-        out_dir = tempfile.gettempdir()
         # First compute dseg files
         # Build files_convert
         current_dir = dirname(abspath(__file__))
@@ -1261,6 +1715,569 @@ class ImportGiftiTest(ScriptedLoadableModuleTest):
         files_convert += [(tmp_file, []) for tmp_file in tmp_files]
         # Ony set to visible the second file
         files_visible.append(tmp_files[-1])
-        ImportGiftiLogic().convertToSlicer(str(out_dir), files_convert, files_visible)
+        # Empty output dir, so the files are converted and not loaded from a previous run
+        with tempfile.TemporaryDirectory() as out_dir:
+            logic = ImportGiftiLogic()
+            self.assertEqual(
+                logic.convertToSlicer(out_dir, files_convert, files_visible), []
+            )
+            # Invalid files are skipped
+            self.assertEqual(
+                len(logic.readManifest(out_dir)), len(files_convert) - len(tmp_files)
+            )
 
         self.delayDisplay("dseg+surf test passed!")
+
+    def test_ImportGifti_reuse(self):
+        """
+        Tests that files already converted are loaded from the output directory instead of
+        converted again, and converted again if requested.
+        """
+        import tempfile
+        from os.path import dirname, abspath
+
+        current_dir = dirname(abspath(__file__))
+        colortable = os.path.join(
+            current_dir, "Resources/Data/desc-subfields_atlas-bigbrain_dseg.tsv"
+        )
+        test_dir = os.path.join(current_dir, "Resources/Data/Test/sub-001")
+        files_convert = [
+            (
+                os.path.join(
+                    test_dir,
+                    "surf/sub-001_hemi-L_space-T1w_den-0p5mm_label-hipp_midthickness.surf.gii",
+                ),
+                [
+                    (
+                        os.path.join(
+                            test_dir,
+                            "surf/sub-001_hemi-L_space-T1w_den-0p5mm_label-hipp_atlas-bigbrain_subfields.label.gii",
+                        ),
+                        colortable,
+                    )
+                ],
+            ),
+            (
+                os.path.join(
+                    test_dir,
+                    "anat/sub-001_hemi-L_space-cropT1w_desc-subfields_atlas-bigbrain_dseg.nii.gz",
+                ),
+                (colortable, False),
+            ),
+        ]
+        files_visible = [files_convert[0][0]]
+        # Empty output dir, removed at the end of the test
+        with tempfile.TemporaryDirectory() as out_dir:
+            logic = ImportGiftiLogic()
+            messages = []
+            logic.progressCallback = lambda message, value: messages.append(message)
+            logic.convertToSlicer(out_dir, files_convert, files_visible)
+            self.assertEqual(len([m for m in messages if m.startswith("Wrote")]), 2)
+            self.assertEqual(len(logic.readManifest(out_dir)), 2)
+            # Second import only loads the files
+            messages.clear()
+            logic.convertToSlicer(out_dir, files_convert, files_visible)
+            self.assertEqual(len([m for m in messages if m.startswith("Loaded")]), 2)
+            self.assertFalse([m for m in messages if m.startswith("Wrote")])
+            modelNode = slicer.util.getNode(
+                "sub-001_hemi-L_space-T1w_den-0p5mm_label-hipp_midthickness*"
+            )
+            self.assertEqual(
+                modelNode.GetDisplayNode().GetActiveScalarName(), "bigbrain_subfields"
+            )
+            # The converted and the loaded segmentations have the same segments
+            converted, loaded = [
+                [
+                    (
+                        segmentation.GetNthSegmentID(index),
+                        segmentation.GetNthSegment(index).GetLabelValue(),
+                        segmentation.GetNthSegment(index).GetName(),
+                    )
+                    for index in range(segmentation.GetNumberOfSegments())
+                ]
+                for segmentation in [
+                    node.GetSegmentation()
+                    for node in slicer.util.getNodesByClass("vtkMRMLSegmentationNode")
+                ]
+            ]
+            self.assertTrue(converted)
+            self.assertEqual(converted, loaded)
+            # Files are converted again if the outputs are not reused
+            messages.clear()
+            logic.convertToSlicer(
+                out_dir, files_convert, files_visible, reuseOutputs=False
+            )
+            self.assertEqual(len([m for m in messages if m.startswith("Wrote")]), 2)
+
+        self.delayDisplay("reuse test passed!")
+
+    def test_ImportGifti_closed_surface_cache(self):
+        """
+        Tests that the closed surfaces of a visible segmentation are cached next to its seg.nrrd,
+        restored when it is loaded again and generated again if their parameters change.
+        """
+        import tempfile
+        from os.path import dirname, abspath
+
+        current_dir = dirname(abspath(__file__))
+        colortable = os.path.join(
+            current_dir, "Resources/Data/desc-subfields_atlas-bigbrain_dseg.tsv"
+        )
+        dseg = os.path.join(
+            current_dir,
+            "Resources/Data/Test/sub-001/anat/sub-001_hemi-L_space-cropT1w_desc-subfields_atlas-bigbrain_dseg.nii.gz",
+        )
+        # Empty output dir, removed at the end of the test
+        with tempfile.TemporaryDirectory() as out_dir:
+            logic = ImportGiftiLogic()
+            params = logic.closedSurfaceParameters()
+            files_convert = [(dseg, (colortable, False, params))]
+            logic.convertToSlicer(out_dir, files_convert, [dseg])
+            cacheFile = logic.closedSurfaceFile(
+                logic.outputFile(dseg, out_dir, logic.output_extension[".nii.gz"])
+            )
+            key = logic.closedSurfaceKey(files_convert[0])
+            surfaces = logic.read_closed_surfaces(cacheFile, key)
+            self.assertIsNotNone(surfaces)
+            # The format of the seg.nrrd does not change the surfaces
+            logic.setOutputOptions({"nrrd_encoding": "raw"})
+            self.assertEqual(logic.closedSurfaceKey(files_convert[0]), key)
+            logic.setOutputOptions(None)
+            # The segmentation is loaded with the cached surfaces
+            mtime = os.stat(cacheFile).st_mtime_ns
+            slicer.mrmlScene.Clear()
+            logic.convertToSlicer(out_dir, files_convert, [dseg])
+            self.assertEqual(os.stat(cacheFile).st_mtime_ns, mtime)
+            segmentationNode = slicer.util.getNode("sub-001*")
+            self.assertTrue(
+                segmentationNode.GetSegmentation().ContainsRepresentation(
+                    slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+                )
+            )
+            # Other parameters generate the surfaces again
+            params = logic.closedSurfaceParameters({"smoothing": 0.2})
+            files_convert = [(dseg, (colortable, False, params))]
+            logic.convertToSlicer(out_dir, files_convert, [dseg])
+            key = logic.closedSurfaceKey(files_convert[0])
+            self.assertEqual(
+                len(logic.read_closed_surfaces(cacheFile, key)), len(surfaces)
+            )
+
+        self.delayDisplay("closed surface cache test passed!")
+
+    def test_ImportGifti_levels_of_detail(self):
+        """
+        Tests that the surfaces imported before the last ones are shown as decimated proxies
+        (with their scalars), and at full resolution again when selected.
+        """
+        import tempfile
+        from os.path import dirname, abspath
+
+        current_dir = dirname(abspath(__file__))
+        colortable = os.path.join(
+            current_dir, "Resources/Data/desc-subfields_atlas-bigbrain_dseg.tsv"
+        )
+        test_dir = os.path.join(current_dir, "Resources/Data/Test/sub-001/surf")
+        surf_L = os.path.join(
+            test_dir,
+            "sub-001_hemi-L_space-T1w_den-0p5mm_label-hipp_midthickness.surf.gii",
+        )
+        label_L = os.path.join(
+            test_dir,
+            "sub-001_hemi-L_space-T1w_den-0p5mm_label-hipp_atlas-bigbrain_subfields.label.gii",
+        )
+        surf_R = os.path.join(
+            test_dir,
+            "sub-001_hemi-R_space-T1w_den-0p5mm_label-hipp_midthickness.surf.gii",
+        )
+        # Empty output dir, removed at the end of the test
+        with tempfile.TemporaryDirectory() as out_dir:
+            logic = ImportGiftiLogic()
+            logic.setDisplayOptions({"surface_proxies": True, "proxy_reduction": 0.8})
+            logic.convertToSlicer(
+                out_dir, [(surf_L, [(label_L, colortable)])], [surf_L]
+            )
+            modelNode = slicer.util.getNode(
+                "sub-001_hemi-L_space-T1w_den-0p5mm_label-hipp_midthickness*"
+            )
+            displayNode = modelNode.GetDisplayNode()
+            polys = modelNode.GetPolyData().GetNumberOfPolys()
+            # The first surface is shown as its proxy when the second one is imported
+            logic.convertToSlicer(out_dir, [(surf_R, [])], [surf_R])
+            proxy = displayNode.GetOutputPolyData()
+            self.assertLess(proxy.GetNumberOfPolys(), polys)
+            self.assertIsNotNone(proxy.GetPointData().GetArray("bigbrain_subfields"))
+            # while the model keeps its full resolution surface (e.g. to save the scene)
+            self.assertEqual(modelNode.GetPolyData().GetNumberOfPolys(), polys)
+            # and shown at full resolution when selected again
+            logic.setFullResolutionFiles([surf_L])
+            self.assertEqual(displayNode.GetOutputPolyData().GetNumberOfPolys(), polys)
+            # The levels of detail of a removed model are forgotten
+            modelNodeID = modelNode.GetID()
+            slicer.mrmlScene.RemoveNode(modelNode)
+            self.assertNotIn(modelNodeID, logic._levelsOfDetail)
+            logic.clearLevelsOfDetail()
+
+        self.delayDisplay("levels of detail test passed!")
+
+    def test_ImportGifti_files_model(self):
+        """
+        Tests the model of the files table: its headers, the check states of the files and the
+        rule that only converted files can be visible.
+        """
+        files = [
+            "sub-001/surf/sub-001_hemi-L_space-T1w_den-0p5mm_label-hipp_midthickness.surf.gii",
+            "sub-001/surf/sub-001_hemi-R_space-T1w_den-0p5mm_label-hipp_midthickness.surf.gii",
+            "sub-001/anat/sub-001_hemi-L_space-cropT1w_desc-subfields_atlas-bigbrain_dseg.nii.gz",
+        ]
+        model = ImportGiftiFilesModel()
+        model.setFiles(files)
+        self.assertEqual(model.rowCount(), len(files))
+        self.assertEqual(
+            [
+                model.headerData(column, qt.Qt.Horizontal)
+                for column in range(model.columnCount())
+            ],
+            ["Filename", "Convert", "Visible"],
+        )
+        self.assertEqual(model.data(model.index(1, model.FilenameColumn)), files[1])
+        # All the files are checked
+        self.assertEqual(model.checkedFiles(model.ConvertColumn), files)
+        self.assertEqual(model.checkedFiles(model.VisibleColumn), files)
+        # Unchecking a file in the 'Convert' column also unchecks it in the 'Visible' one
+        convertIndex = model.index(1, model.ConvertColumn)
+        visibleIndex = model.index(1, model.VisibleColumn)
+        self.assertTrue(
+            model.setData(convertIndex, qt.Qt.Unchecked, qt.Qt.CheckStateRole)
+        )
+        self.assertEqual(
+            model.data(convertIndex, qt.Qt.CheckStateRole), qt.Qt.Unchecked
+        )
+        self.assertEqual(
+            model.data(visibleIndex, qt.Qt.CheckStateRole), qt.Qt.Unchecked
+        )
+        self.assertEqual(model.checkedFiles(model.ConvertColumn), [files[0], files[2]])
+        # and it cannot be visible until it is converted again
+        model.setData(visibleIndex, qt.Qt.Checked, qt.Qt.CheckStateRole)
+        self.assertEqual(model.checkedFiles(model.VisibleColumn), [files[0], files[2]])
+        self.assertFalse(model.allChecked(model.ConvertColumn))
+        model.setAllChecked(model.ConvertColumn, True)
+        self.assertTrue(model.allChecked(model.ConvertColumn))
+        self.assertFalse(model.allChecked(model.VisibleColumn))
+        # Rows are numbered in the vertical header
+        self.assertEqual(model.headerData(0, qt.Qt.Vertical), 1)
+        # The check boxes of the table are toggled with the space key
+        view = qt.QTableView()
+        view.setModel(model)
+        delegate = ImportGiftiCheckDelegate(view)
+        spaceKey = qt.QKeyEvent(qt.QEvent.KeyPress, qt.Qt.Key_Space, qt.Qt.NoModifier)
+        option = qt.QStyleOptionViewItem()
+        self.assertFalse(model.isChecked(1, model.VisibleColumn))
+        self.assertTrue(delegate.editorEvent(spaceKey, model, option, visibleIndex))
+        self.assertTrue(model.isChecked(1, model.VisibleColumn))
+        self.assertFalse(
+            delegate.editorEvent(
+                spaceKey, model, option, model.index(1, model.FilenameColumn)
+            )
+        )
+
+        self.delayDisplay("files model test passed!")
+
+    def test_ImportGifti_gifti_reader(self):
+        """
+        Tests that the gifti reader returns the same arrays as nibabel for all the test files.
+        """
+        import glob
+        import tempfile
+        import numpy as np
+        import nibabel as nb
+        from os.path import dirname, abspath
+        from ImportGiftiLib import gifti
+
+        current_dir = dirname(abspath(__file__))
+        gifti_files = glob.glob(
+            os.path.join(current_dir, "Resources/Data/Test/*/surf/*.gii")
+        )
+        self.assertTrue(gifti_files)
+        for gifti_file in gifti_files:
+            gii_data = nb.load(gifti_file)
+            if gifti_file.endswith(".surf.gii"):
+                vertices, faces = gifti.read_surface(gifti_file)
+                expected = [
+                    (vertices, "NIFTI_INTENT_POINTSET"),
+                    (faces, "NIFTI_INTENT_TRIANGLE"),
+                ]
+                for data, intent in expected:
+                    expected_data = gii_data.get_arrays_from_intent(intent)[0].data
+                    self.assertEqual(data.dtype, expected_data.dtype)
+                    np.testing.assert_array_equal(data, expected_data)
+            else:
+                values = gifti.read_values(gifti_file)
+                self.assertEqual(values.dtype, gii_data.agg_data().dtype)
+                np.testing.assert_array_equal(values, gii_data.agg_data())
+        # Several data arrays are only stacked for time series
+        gii = nb.gifti.GiftiImage()
+        for intent in ["NIFTI_INTENT_SHAPE", "NIFTI_INTENT_SHAPE"]:
+            gii.add_gifti_data_array(
+                nb.gifti.GiftiDataArray(np.zeros(4, dtype=np.float32), intent=intent)
+            )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gifti_file = os.path.join(tmp_dir, "two_arrays.shape.gii")
+            nb.save(gii, gifti_file)
+            with self.assertRaises(ValueError):
+                gifti.read_values(gifti_file)
+            self.assertEqual(len(gifti.read_arrays(gifti_file, first=True)), 1)
+
+        self.delayDisplay("gifti reader test passed!")
+
+    def test_ImportGifti_output_formats(self):
+        """
+        Tests that the segmentations written with each nrrd encoding (also compressed in
+        parallel blocks) and the surfaces written in each format are read back unchanged.
+        """
+        import tempfile
+        import nrrd
+        from os.path import dirname, abspath
+        from vtk.util import numpy_support
+
+        current_dir = dirname(abspath(__file__))
+        colortable = os.path.join(
+            current_dir, "Resources/Data/desc-subfields_atlas-bigbrain_dseg.tsv"
+        )
+        test_dir = os.path.join(current_dir, "Resources/Data/Test/sub-001")
+        dseg = os.path.join(
+            test_dir,
+            "anat/sub-001_hemi-L_space-cropT1w_desc-subfields_atlas-bigbrain_dseg.nii.gz",
+        )
+        surf = os.path.join(
+            test_dir,
+            "surf/sub-001_hemi-L_space-T1w_den-0p5mm_label-hipp_midthickness.surf.gii",
+        )
+        label = os.path.join(
+            test_dir,
+            "surf/sub-001_hemi-L_space-T1w_den-0p5mm_label-hipp_atlas-bigbrain_subfields.label.gii",
+        )
+        logic = ImportGiftiLogic()
+        seg = logic.read_dseg((dseg, (colortable, False)))
+        # Small blocks (the last one shorter), so the data is split in many blocks
+        logic.nrrdBlockSize = 999
+        self.assertGreater(seg["data"].nbytes, 10 * logic.nrrdBlockSize)
+        self.assertNotEqual(seg["data"].nbytes % logic.nrrdBlockSize, 0)
+        with tempfile.TemporaryDirectory() as out_dir:
+            seg_file = os.path.join(out_dir, "dseg.seg.nrrd")
+            for options in [
+                {"nrrd_encoding": "raw"},
+                {"nrrd_encoding": "gzip"},
+                {"nrrd_encoding": "gzip", "nrrd_threads": 4},
+                {
+                    "nrrd_encoding": "gzip",
+                    "nrrd_threads": 4,
+                    "nrrd_compression_level": 1,
+                },
+            ]:
+                logic.setOutputOptions(options)
+                logic.write_nrrd(seg, seg_file)
+                data, header = nrrd.read(seg_file)
+                self.assertEqual(header["encoding"], options["nrrd_encoding"])
+                self.assertEqual(header["Segment0_ID"], seg["header"]["Segment0_ID"])
+                self.assertEqual(data.dtype, seg["data"].dtype)
+                np.testing.assert_array_equal(data, seg["data"])
+
+            surface = logic.read_surf((surf, [(label, colortable)]))
+            mesh = logic.makePolyData(
+                surface["vertices"], surface["faces"], surface["scalars"]
+            )
+            for options in [
+                {"vtk_encoding": "binary"},
+                {"vtk_encoding": "ascii"},
+                {"surface_format": "vtp", "vtp_compression": "zlib"},
+                {"surface_format": "vtp", "vtp_compression": "lz4"},
+                {"surface_format": "vtp", "vtp_compression": "none"},
+            ]:
+                logic.setOutputOptions(options)
+                out_file = os.path.join(out_dir, "surf" + logic.surfaceExtension())
+                logic.write_surf(mesh, out_file)
+                if out_file.endswith(".vtp"):
+                    reader = vtk.vtkXMLPolyDataReader()
+                else:
+                    reader = vtk.vtkPolyDataReader()
+                reader.SetFileName(out_file)
+                reader.Update()
+                output = reader.GetOutput()
+                # ascii files keep fewer digits
+                np.testing.assert_allclose(
+                    numpy_support.vtk_to_numpy(output.GetPoints().GetData()),
+                    surface["vertices"],
+                    rtol=1e-5,
+                )
+                np.testing.assert_array_equal(
+                    numpy_support.vtk_to_numpy(
+                        output.GetPolys().GetConnectivityArray()
+                    ).reshape(-1, 3),
+                    surface["faces"],
+                )
+                for name, values in surface["scalars"].items():
+                    np.testing.assert_allclose(
+                        numpy_support.vtk_to_numpy(
+                            output.GetPointData().GetArray(name)
+                        ),
+                        values,
+                        rtol=1e-5,
+                    )
+        # Invalid options are rejected without changing the current ones
+        outputOptions = dict(logic.outputOptions)
+        for options in [{"surface_format": "obj"}, {"nrrd_threads": 1.5}, {"x": 1}]:
+            with self.assertRaises(ValueError):
+                logic.setOutputOptions(options)
+            self.assertEqual(logic.outputOptions, outputOptions)
+
+        self.delayDisplay("output formats test passed!")
+
+    def test_ImportGifti_empty_dseg(self):
+        """
+        Tests that a segmentation without any label (all zero) is converted and loaded without
+        segments.
+        """
+        import tempfile
+        import nibabel as nb
+        from os.path import dirname, abspath
+
+        current_dir = dirname(abspath(__file__))
+        colortable = os.path.join(
+            current_dir, "Resources/Data/desc-subfields_atlas-bigbrain_dseg.tsv"
+        )
+        logic = ImportGiftiLogic()
+        data_obj = nb.Nifti1Image(np.zeros((8, 8, 8), dtype=np.int16), np.eye(4))
+        seg = logic.prepare_dseg(data_obj, logic.getColortable(colortable), False)
+        # The whole volume is kept (there is nothing to crop to), without segments
+        self.assertEqual(seg["data"].shape, (8, 8, 8))
+        self.assertEqual(seg["segments"], [])
+        self.assertFalse([key for key in seg["header"] if key.startswith("Segment0")])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dseg = os.path.join(
+                tmp_dir, "bids/sub-001/anat/sub-001_desc-empty_dseg.nii.gz"
+            )
+            os.makedirs(os.path.dirname(dseg))
+            nb.save(data_obj, dseg)
+            out_dir = os.path.join(tmp_dir, "output")
+            failed = logic.convertToSlicer(
+                out_dir, [(dseg, (colortable, False))], [dseg]
+            )
+            self.assertEqual(failed, [])
+            segmentationNode = slicer.util.getNode("sub-001_desc-empty_dseg")
+            self.assertEqual(
+                segmentationNode.GetSegmentation().GetNumberOfSegments(), 0
+            )
+
+        self.delayDisplay("empty dseg test passed!")
+
+    def test_ImportGifti_dseg_type(self):
+        """
+        Tests that the labels are written to seg.nrrd with the smallest integer type that fits
+        their range, whatever the type they are stored with in the nifti file.
+        """
+        import tempfile
+        import nrrd
+        import nibabel as nb
+        from os.path import dirname, abspath
+
+        current_dir = dirname(abspath(__file__))
+        colortable = os.path.join(
+            current_dir, "Resources/Data/desc-subfields_atlas-bigbrain_dseg.tsv"
+        )
+        logic = ImportGiftiLogic()
+        atlas_labels = logic.getColortable(colortable)
+        # Labels inside a 4x4x4 cube (the cropped volume)
+        labels = np.zeros((6, 6, 6))
+        labels[1:5, 1:5, 1:5] = 1
+        labels[2, 2, 2] = 5
+        negative = labels * 200
+        negative[3, 3, 3] = -3
+        # (labels, type in the nifti file, expected type in the seg.nrrd)
+        cases = [
+            (labels, np.int16, np.uint8),
+            (labels * 200, np.int32, np.uint16),
+            (negative, np.int16, np.int16),
+            # Labels stored as floats are rounded
+            (labels * 0.9999, np.float32, np.uint8),
+        ]
+        with tempfile.TemporaryDirectory() as out_dir:
+            seg_file = os.path.join(out_dir, "dseg.seg.nrrd")
+            for data, nifti_type, expected_type in cases:
+                data_obj = nb.Nifti1Image(data.astype(nifti_type), np.eye(4))
+                seg = logic.prepare_dseg(data_obj, atlas_labels, True)
+                logic.write_nrrd(seg, seg_file)
+                seg_data, header = nrrd.read(seg_file)
+                self.assertEqual(seg_data.dtype, expected_type)
+                self.assertEqual(header["type"], np.dtype(expected_type).name)
+                np.testing.assert_array_equal(seg_data, np.rint(data)[1:5, 1:5, 1:5])
+
+        self.delayDisplay("dseg type test passed!")
+
+    def test_ImportGifti_dseg_labels(self):
+        """
+        Tests the segments written to the seg.nrrd header for labels in the colortable, labels
+        not in the colortable (unknown) and the background, with and without show_unknown.
+        """
+        import pandas as pd
+        import nibabel as nb
+
+        logic = ImportGiftiLogic()
+        # Unsorted colortable without the background
+        atlas_labels = logic.make_label_lookup(
+            pd.DataFrame(
+                {
+                    "index": [5, 1, 2],
+                    "name": ["five", "one", "two"],
+                    "abbreviation": ["E", "A", "B"],
+                    "r": [0, 255, 0],
+                    "g": [0, 0, 255],
+                    "b": [255, 0, 0],
+                }
+            )
+        )
+        data = np.zeros((6, 6, 6), dtype=np.int16)
+        data[1, 1, 1] = 1
+        data[2, 2, 2] = 5
+        data[3, 3, 3] = 7
+        data_obj = nb.Nifti1Image(data, np.eye(4))
+        # (show_unknown, expected segments (ID, label value, name, color))
+        cases = [
+            (
+                False,
+                [("Segment_1", 1, "A", "1 0 0 1"), ("Segment_5", 5, "E", "0 0 1 1")],
+            ),
+            (
+                True,
+                [
+                    ("Segment_0", 0, "Unknown", "0 0 0 0"),
+                    ("Segment_1", 1, "A", "1 0 0 1"),
+                    ("Segment_5", 5, "E", "0 0 1 1"),
+                    ("Segment_7", 7, "Unknown", "0 0 0 0"),
+                ],
+            ),
+        ]
+        for show_unknown, expected_segments in cases:
+            seg = logic.prepare_dseg(data_obj, atlas_labels, show_unknown)
+            header = seg["header"]
+            segments = []
+            index = 0
+            while f"Segment{index}_ID" in header:
+                name = f"Segment{index}"
+                color = [float(value) for value in header[name + "_Color"].split()]
+                segments.append(
+                    (
+                        header[name + "_ID"],
+                        int(header[name + "_LabelValue"]),
+                        header[name + "_Name"],
+                        " ".join(f"{value:g}" for value in color),
+                    )
+                )
+                index += 1
+            self.assertEqual(segments, expected_segments)
+            self.assertEqual(
+                [label for label, _, _ in seg["segments"]],
+                [label for _, label, _, _ in expected_segments],
+            )
+
+        self.delayDisplay("dseg labels test passed!")
@@ -0,0 +1,15 @@
+from .conversion import (
+    MODULE_DIR,
+    MANIFEST_NAME,
+    OUTPUT_OPTIONS,
+    CLOSED_SURFACE_OPTIONS,
+    ImportGiftiConverter,
+)
+
+__all__ = [
+    "MODULE_DIR",
+    "MANIFEST_NAME",
+    "OUTPUT_OPTIONS",
+    "CLOSED_SURFACE_OPTIONS",
+    "ImportGiftiConverter",
+]
@@ -0,0 +1,222 @@
+"""
+Headless conversion of a whole BIDS dataset (all the subjects, without the Slicer scene).
+Surfaces are saved as vtk (or vtp) and segmentations as seg.nrrd, in the same folders as the
+ImportGifti module does, in the format set in the 'output' section of the config file. The
+files are converted in parallel in a pool of processes, and files that are up to date in the
+manifest of the output directory are skipped.
+
+It can be run with any Python with the module requirements (vtk, nibabel, pynrrd, pandas,
+pybids and pyyaml), e.g. with Slicer's Python:
+
+    PythonSlicer ImportGiftiLib/batch.py <bids_dir> <config.yml> <output_dir>
+
+or from Slicer without GUI:
+
+    Slicer --no-main-window --python-script ImportGiftiLib/batch.py <bids_dir> <config.yml> <output_dir>
+"""
+import argparse
+import concurrent.futures
+import os
+import sys
+
+if __name__ == "__main__":
+    # Make ImportGiftiLib importable when this file is run as a script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ImportGiftiLib.conversion import MODULE_DIR, OUTPUT_OPTIONS, ImportGiftiConverter
+
+# Converter of each worker process (it keeps the colortables already read)
+_converter = None
+
+
+def convertFile(file, OutputPath, outputOptions=None):
+    """
+    Converts one input returned by ImportGiftiConverter.resolveFiles and saves it in OutputPath
+    in the format given by outputOptions (see ImportGiftiConverter.setOutputOptions).
+    Returns the path of the saved file and its display settings (for the manifest).
+    """
+    global _converter
+    if _converter is None:
+        _converter = ImportGiftiConverter()
+    _converter.setOutputOptions(outputOptions)
+    # The files of a subject are split among the processes, so decoded scalars are not kept
+    _converter.clearScalarCache()
+    path = file[0]
+    if path.endswith(".surf.gii"):
+        surface = _converter.read_surf(file)
+        # Vertices are saved in LPS
+        vertices = surface["vertices"] * [-1, -1, 1]
+        mesh = _converter.makePolyData(vertices, surface["faces"], surface["scalars"])
+        out_file = _converter.outputFile(
+            path, OutputPath, _converter.surfaceExtension()
+        )
+        _converter.write_surf(mesh, out_file)
+        return out_file, _converter.surfaceDisplay(surface)
+    elif path.endswith(".nii.gz"):
+        out_file = _converter.outputFile(path, OutputPath, ".seg.nrrd")
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+        _converter.write_nrrd(_converter.read_dseg(file), out_file)
+        return out_file, None
+    raise ValueError(f"File type of {os.path.basename(path)} is not supported.")
+
+
+def outputExtension(file, surfaceExtension=".vtk"):
+    """
+    Returns the extension of the file an input is converted to (None if it is not supported).
+    """
+    if file[0].endswith(".surf.gii"):
+        return surfaceExtension
+    if file[0].endswith(".nii.gz"):
+        return ".seg.nrrd"
+    return None
+
+
+def convertDataset(
+    bids_dir,
+    config_file,
+    OutputPath,
+    subjects=None,
+    workers=None,
+    outputOptions=None,
+    progressCallback=None,
+    reuseOutputs=True,
+):
+    """
+    Converts the files of the given subjects (all of them by default) of a BIDS directory,
+    selected with the 'pybids_inputs' of a config file. outputOptions overrides the format of
+    the converted files set in the 'output' section of the config file. workers is the number
+    of processes (as many as CPUs by default; with 1 the files are converted in this process).
+    progressCallback is called with a message for each file. Files of types that are not
+    supported are skipped (as in the module), and if reuseOutputs is set, the files that are
+    up to date in the manifest of OutputPath are not converted again. Returns the
+    list of saved files and the list of (input file, error) of the files that could not be
+    converted.
+    """
+    import yaml
+
+    converter = ImportGiftiConverter()
+    with open(config_file) as file:
+        config = yaml.load(file, Loader=yaml.FullLoader)
+    pybids_inputs = config["pybids_inputs"]
+    outputOptions = dict(config.get("output") or {}, **(outputOptions or {}))
+    converter.setOutputOptions(outputOptions)
+    layout = converter.getLayout(
+        bids_dir, os.path.join(MODULE_DIR, "Resources", "Data", "bids.json")
+    )
+    if subjects is None:
+        subjects = layout.get(return_type="id", target="subject")
+    files = converter.resolveFiles(layout, pybids_inputs, subjects)
+    if progressCallback is None:
+        progressCallback = lambda message: None
+    # Skip the files already converted from the same sources
+    manifest = converter.readManifest(OutputPath)
+    jobs = []
+    records = {}
+    for file in [file for subj in subjects for file in files[subj]]:
+        extension = outputExtension(file, converter.surfaceExtension())
+        if extension is None:
+            progressCallback(f"Skipped (file type not supported): {file[0]}")
+            continue
+        out_file = converter.outputFile(file[0], OutputPath, extension)
+        records[file[0]] = converter.conversionRecord(file)
+        if reuseOutputs and converter.upToDate(
+            manifest, OutputPath, out_file, records[file[0]]
+        ):
+            progressCallback(f"Up to date: {out_file}")
+            continue
+        jobs.append(file)
+
+    converted = []
+    failed = []
+
+    def collect(index, file, convert):
+        try:
+            out_file, display = convert()
+            converted.append(out_file)
+            record = records[file[0]]
+            if display is not None:
+                record["display"] = display
+            manifest[os.path.relpath(out_file, OutputPath)] = record
+            progressCallback(f"[{index}/{len(jobs)}] Wrote {out_file}")
+        except Exception as error:
+            failed.append((file[0], error))
+            progressCallback(
+                f"[{index}/{len(jobs)}] Failed to convert {file[0]}: {error}"
+            )
+
+    try:
+        if workers == 1:
+            for index, file in enumerate(jobs, 1):
+                collect(
+                    index, file, lambda: convertFile(file, OutputPath, outputOptions)
+                )
+        else:
+            with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                futures = {
+                    executor.submit(convertFile, file, OutputPath, outputOptions): file
+                    for file in jobs
+                }
+                for index, future in enumerate(
+                    concurrent.futures.as_completed(futures), 1
+                ):
+                    collect(index, futures[future], future.result)
+    finally:
+        # Keep the files converted so far, even if the conversion was interrupted
+        if converted:
+            converter.writeManifest(OutputPath, manifest)
+    return converted, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert the gifti surfaces and nifti segmentations of a BIDS directory "
+        "to vtk and seg.nrrd files."
+    )
+    parser.add_argument("bids_dir", help="BIDS directory")
+    parser.add_argument("config", help="config file (yml) with the inputs to convert")
+    parser.add_argument("output_dir", help="directory where the files are saved")
+    parser.add_argument(
+        "--subjects", nargs="+", help="subjects to convert (default: all of them)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of processes (default: number of CPUs)",
+    )
+    # Output format (overrides the 'output' section of the config file)
+    for option, (default, values) in OUTPUT_OPTIONS.items():
+        if isinstance(values, range):
+            kwargs = {"type": int, "metavar": f"{{{values[0]}..{values[-1]}}}"}
+        else:
+            kwargs = {}
+        parser.add_argument(
+            "--" + option.replace("_", "-"),
+            choices=values,
+            help=f"(default: '{option}' of the config file, or {default})",
+            **kwargs,
+        )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="convert again the files that are up to date",
+    )
+    args = parser.parse_args(argv)
+    _, failed = convertDataset(
+        args.bids_dir,
+        args.config,
+        args.output_dir,
+        subjects=args.subjects,
+        workers=args.workers,
+        outputOptions={
+            option: getattr(args, option)
+            for option in OUTPUT_OPTIONS
+            if getattr(args, option) is not None
+        },
+        progressCallback=print,
+        reuseOutputs=not args.force,
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,923 @@
+"""
+Conversion of BIDS gifti surfaces and nifti segmentations that does not depend on the Slicer
+application (no scene, no GUI). It is shared by ImportGiftiLogic and the batch conversion, and
+can be run in worker threads and processes.
+"""
+import os
+import concurrent.futures
+import hashlib
+import io
+import json
+import struct
+import threading
+import zlib
+from pathlib import Path
+
+import numpy as np
+import vtk
+
+from . import gifti
+
+__all__ = [
+    "MODULE_DIR",
+    "MANIFEST_NAME",
+    "OUTPUT_OPTIONS",
+    "CLOSED_SURFACE_OPTIONS",
+    "ImportGiftiConverter",
+]
+
+# Folder of the ImportGifti module (paths of the config file are relative to it)
+MODULE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Manifest of the converted files, saved in the output directory
+MANIFEST_NAME = "ImportGifti_manifest.json"
+# Increased whenever the converted files change, so older outputs are converted again
+CONVERSION_VERSION = 1
+# Format of the converted files ('output' section of the config file): option -> (default,
+# allowed values). nrrd_threads > 1 compresses blocks of the segmentations in parallel.
+OUTPUT_OPTIONS = {
+    "surface_format": ("vtk", ["vtk", "vtp"]),
+    "vtk_encoding": ("binary", ["binary", "ascii"]),
+    "vtp_compression": ("zlib", ["zlib", "lz4", "none"]),
+    "nrrd_encoding": ("gzip", ["gzip", "raw"]),
+    "nrrd_compression_level": (9, range(1, 10)),
+    "nrrd_threads": (1, range(1, 1025)),
+}
+# Output options that change the files converted to each extension (the number of threads
+# does not change the converted files)
+RECORDED_OUTPUT_OPTIONS = {
+    ".vtk": ["surface_format", "vtk_encoding"],
+    ".vtp": ["surface_format", "vtp_compression"],
+    ".seg.nrrd": ["nrrd_encoding", "nrrd_compression_level"],
+}
+# Default size of the blocks compressed in parallel when writing nrrd files
+NRRD_BLOCK_SIZE = 1 << 20
+# Parameters of the closed surfaces of the segmentations ('closed_surface' of a segmentation
+# input in the config file): option -> (Slicer conversion parameter, default). Values are in [0, 1].
+CLOSED_SURFACE_OPTIONS = {
+    "smoothing": ("Smoothing factor", 0.5),
+    "decimation": ("Decimation factor", 0.0),
+}
+# Field data array of the cached closed surfaces with the key they were generated with
+CLOSED_SURFACE_KEY = "ImportGiftiKey"
+
+
+class ImportGiftiConverter:
+    """
+    Reads the inputs of a BIDS directory (see resolveFiles) and converts them to arrays,
+    vtkPolyData and seg.nrrd files.
+    """
+
+    def __init__(self, layoutDatabasePath=None):
+        # Folder where the BIDS layouts are persisted
+        if layoutDatabasePath is None:
+            layoutDatabasePath = os.path.join(
+                os.path.expanduser("~"), ".cache", "ImportGifti", "layouts"
+            )
+        self.layoutDatabasePath = layoutDatabasePath
+        # BIDS layouts already loaded: (directory, config) -> (fingerprint, layout)
+        self._layouts = {}
+        # Parsed colortables, by colortable file version
+        self._colortables = {}
+        # Triangles shared by the surfaces with the same topology: faces key -> vtkCellArray
+        self._sharedCells = {}
+        # Scalar files decoded in the current import: path -> future of the array, and the vtk
+        # arrays attached to the surfaces: (path, scalar name) -> vtkDataArray
+        self._scalars = {}
+        self._scalarsLock = threading.Lock()
+        self._scalarArrays = {}
+        # Format of the converted files (see OUTPUT_OPTIONS)
+        self.outputOptions = {
+            option: default for option, (default, _) in OUTPUT_OPTIONS.items()
+        }
+        # Size of the blocks compressed in parallel when writing nrrd files
+        self.nrrdBlockSize = NRRD_BLOCK_SIZE
+
+    def setOutputOptions(self, options):
+        """
+        Sets the format of the converted files from the 'output' section of a config file
+        (options not given keep their default value, see OUTPUT_OPTIONS).
+        """
+        self.outputOptions = self.validateOutputOptions(options)
+
+    def validateOutputOptions(self, options):
+        """
+        Returns all the output options given by the 'output' section of a config file, with
+        their default value if they are not given. Raises ValueError if an option is invalid.
+        """
+        outputOptions = {
+            option: default for option, (default, _) in OUTPUT_OPTIONS.items()
+        }
+        for option, value in (options or {}).items():
+            if option not in OUTPUT_OPTIONS:
+                raise ValueError(f"Unknown output option '{option}'")
+            allowed = OUTPUT_OPTIONS[option][1]
+            # Booleans and floats would be accepted by the ranges of integers
+            if (
+                isinstance(value, bool)
+                or (isinstance(allowed, range) and not isinstance(value, int))
+                or value not in allowed
+            ):
+                raise ValueError(f"Invalid value '{value}' of output option '{option}'")
+            outputOptions[option] = value
+        return outputOptions
+
+    def closedSurfaceParameters(self, config=None):
+        """
+        Returns the parameters of the closed surfaces of a segmentation from the 'closed_surface'
+        of its input in a config file (parameters not given keep their default value, see
+        CLOSED_SURFACE_OPTIONS).
+        """
+        params = {
+            option: default for option, (_, default) in CLOSED_SURFACE_OPTIONS.items()
+        }
+        for option, value in (config or {}).items():
+            if option not in CLOSED_SURFACE_OPTIONS:
+                raise ValueError(f"Unknown closed surface option '{option}'")
+            if (
+                isinstance(value, bool)
+                or not isinstance(value, (int, float))
+                or not 0 <= value <= 1
+            ):
+                raise ValueError(
+                    f"Invalid value '{value}' of closed surface option '{option}'"
+                )
+            params[option] = float(value)
+        return params
+
+    def surfaceExtension(self):
+        """
+        Extension of the converted surfaces (.vtk or .vtp).
+        """
+        return "." + self.outputOptions["surface_format"]
+
+    def getLayout(self, bids_dir, config):
+        """
+        Returns the BIDSLayout of a directory (indexed with the given pybids config). Each layout
+        is indexed once and persisted as a pybids database in layoutDatabasePath. The index is only
+        rebuilt if the fingerprint of the directory (see directoryFingerprint) changed.
+        """
+        from bids import BIDSLayout
+
+        key = (os.path.abspath(bids_dir), os.path.abspath(config))
+        fingerprint = self.directoryFingerprint(bids_dir)
+        fingerprint["config"] = os.stat(config).st_mtime_ns
+        if key in self._layouts and self._layouts[key][0] == fingerprint:
+            return self._layouts[key][1]
+        # Persistent index of the layout
+        database_path = os.path.join(
+            self.layoutDatabasePath, hashlib.sha1(repr(key).encode()).hexdigest()
+        )
+        fingerprint_file = os.path.join(database_path, "fingerprint.json")
+        try:
+            with open(fingerprint_file) as file:
+                reset_database = json.load(file) != fingerprint
+        except (OSError, ValueError):
+            reset_database = True
+        layout = BIDSLayout(
+            bids_dir,
+            config=config,
+            validate=False,
+            database_path=database_path,
+            reset_database=reset_database,
+        )
+        if reset_database:
+            with open(fingerprint_file, "w") as file:
+                json.dump(fingerprint, file)
+        self._layouts[key] = (fingerprint, layout)
+        return layout
+
+    def resolveFiles(self, layout, pybids_inputs, subjects):
+        """
+        Finds the files of each subject defined by the 'pybids_inputs' of a config file. Each type
+        of input (and of scalar) is queried once for all the subjects, and the scalars are
+        paired to their surfaces by subject and matching entities with a dictionary.
+        Returns a dictionary subject -> list of (surface, [(scalar file, colortable)]) or
+        (segmentation, (colortable, show_unknown, closed surface parameters)).
+        """
+        files = {subj: [] for subj in subjects}
+        for dict_input in pybids_inputs.values():
+            # Look for files based on BIDS
+            input_filters = {"subject": subjects}
+            input_filters.update(dict_input["pybids_filters"])
+            image_files = layout.get(**input_filters)
+            # Check if there are scalars attached
+            # Case 1: gifti with scalars
+            if "scalars" in dict_input:
+                # Index the scalar files by subject and the entities to match
+                scalar_files = []
+                for dict_scalar in dict_input["scalars"].values():
+                    match_entities = dict_scalar.get("match_entities", [])
+                    colortable_path = None
+                    if "colortable" in dict_scalar:
+                        colortable_path = self._resourceFile(dict_scalar["colortable"])
+                    input_filters = {"subject": subjects}
+                    input_filters.update(dict_scalar["pybids_filters"])
+                    scalar_index = {}
+                    for scalar_file in layout.get(**input_filters):
+                        entities = scalar_file.get_entities()
+                        key = (entities["subject"],) + tuple(
+                            entities.get(entity) for entity in match_entities
+                        )
+                        scalar_index.setdefault(key, []).append(
+                            (scalar_file.path, colortable_path)
+                        )
+                    scalar_files.append((match_entities, scalar_index))
+                for image_file in image_files:
+                    # Get entities from surf file
+                    entities = image_file.get_entities()
+                    labels_color = []
+                    for match_entities, scalar_index in scalar_files:
+                        key = (entities["subject"],) + tuple(
+                            entities[entity] for entity in match_entities
+                        )
+                        labels_color += scalar_index.get(key, [])
+                    files[entities["subject"]].append((image_file.path, labels_color))
+            # Case 2: Nifti with colortable (show_unknown defaults to false)
+            elif "colortable" in dict_input:
+                colortable_path = self._resourceFile(dict_input["colortable"])
+                show_unknown = dict_input.get("show_unknown", False)
+                closed_surface = self.closedSurfaceParameters(
+                    dict_input.get("closed_surface")
+                )
+                for image_file in image_files:
+                    files[image_file.get_entities()["subject"]].append(
+                        (
+                            image_file.path,
+                            (colortable_path, show_unknown, closed_surface),
+                        )
+                    )
+            # Case 3: Gifti without scalars
+            else:
+                for image_file in image_files:
+                    files[image_file.get_entities()["subject"]].append(
+                        (image_file.path, [])
+                    )
+        return files
+
+    def _resourceFile(self, path):
+        """
+        Returns the absolute path of a file given in the config file (relative paths are relative
+        to this module).
+        """
+        if not os.path.isabs(path):
+            path = os.path.join(MODULE_DIR, path)
+        return path
+
+    def directoryFingerprint(self, directory):
+        """
+        Summarizes the state of a directory tree with its number of files and the latest
+        modification time of its folders (changed whenever files are added, removed or renamed).
+        """
+        files = 0
+        mtime = 0
+        for root, _, filenames in os.walk(directory):
+            files += len(filenames)
+            mtime = max(mtime, os.stat(root).st_mtime_ns)
+        return {"files": files, "mtime": mtime}
+
+    def outputFile(self, file, OutputPath, extension):
+        """
+        Returns the path where a file is saved: OutputPath/<subject>/<datatype>/<name><extension>
+        (the two parent folders of the input file are kept).
+        """
+        base_filename = os.path.basename(file).split(".", 1)[0]
+        path = Path(file)
+        parent_dir = os.path.join(path.parents[1].name, path.parents[0].name)
+        return os.path.join(OutputPath, parent_dir, f"{base_filename}{extension}")
+
+    def closedSurfaceFile(self, seg_file):
+        """
+        Returns the path where the closed surfaces of a seg.nrrd file are cached (a vtm file
+        with a folder of vtp files, next to it).
+        """
+        return seg_file[: -len(".seg.nrrd")] + ".closedsurface.vtm"
+
+    def inputSources(self, file):
+        """
+        Returns the files a converted file is built from: the input file, its scalars and the
+        colortables.
+        """
+        path, inputs = file
+        if isinstance(inputs, tuple):
+            # Segmentation: (colortable, show_unknown[, closed surface parameters])
+            return [path, inputs[0]]
+        sources = [path]
+        for scalar_file, colortable in inputs:
+            sources += (
+                [scalar_file] if colortable is None else [scalar_file, colortable]
+            )
+        return sources
+
+    def conversionRecord(self, file, **params):
+        """
+        Describes the conversion of a file (see resolveFiles): the size and modification time of
+        each source, the inputs, the output options of its output format and any other
+        conversion parameters. An output whose record did not change is up to date.
+        """
+        path, inputs = file
+        if isinstance(inputs, tuple):
+            # The closed surfaces of a segmentation do not change its seg.nrrd
+            file = (path, inputs[:2])
+            extension = ".seg.nrrd"
+        else:
+            extension = self.surfaceExtension()
+        sources = {}
+        for source in self.inputSources(file):
+            try:
+                stat = os.stat(source)
+                sources[os.path.abspath(source)] = [stat.st_size, stat.st_mtime_ns]
+            except OSError:
+                # Missing sources are reported when the file is converted
+                sources[os.path.abspath(source)] = None
+        # Stored as json, so tuples are compared as lists
+        return json.loads(
+            json.dumps(
+                {
+                    "version": CONVERSION_VERSION,
+                    "sources": sources,
+                    "input": file,
+                    "output": {
+                        option: self.outputOptions[option]
+                        for option in RECORDED_OUTPUT_OPTIONS[extension]
+                    },
+                    "params": params,
+                }
+            )
+        )
+
+    def closedSurfaceKey(self, dseg_file):
+        """
+        Describes the closed surfaces of a segmentation: the size and modification time of its
+        sources, its inputs and the closed surface parameters. The format of the seg.nrrd does
+        not change the surfaces, so it is not part of the key.
+        """
+        _, inputs = dseg_file
+        params = inputs[2] if len(inputs) > 2 else self.closedSurfaceParameters()
+        key = self.conversionRecord(dseg_file, closed_surface=params)
+        del key["output"]
+        return key
+
+    def readManifest(self, OutputPath):
+        """
+        Reads the manifest of the files converted in OutputPath: output file (relative to
+        OutputPath) -> conversion record (see conversionRecord) and display settings.
+        """
+        try:
+            with open(os.path.join(OutputPath, MANIFEST_NAME)) as file:
+                return json.load(file)["outputs"]
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def writeManifest(self, OutputPath, manifest):
+        """
+        Saves the manifest of the files converted in OutputPath (see readManifest).
+        """
+        manifest_file = os.path.join(OutputPath, MANIFEST_NAME)
+        os.makedirs(OutputPath, exist_ok=True)
+        # Write to a temporary file first so the manifest is never left half written
+        with open(manifest_file + ".tmp", "w") as file:
+            json.dump({"outputs": manifest}, file, indent=1)
+        os.replace(manifest_file + ".tmp", manifest_file)
+
+    def upToDate(self, manifest, OutputPath, out_file, record):
+        """
+        Returns the manifest entry of out_file if it exists and was converted with the same
+        record (see conversionRecord), None otherwise.
+        """
+        entry = manifest.get(os.path.relpath(out_file, OutputPath))
+        if entry is None or not os.path.exists(out_file):
+            return None
+        if any(entry.get(key) != value for key, value in record.items()):
+            return None
+        return entry
+
+    def surfaceDisplay(self, surface):
+        """
+        Display settings of a surface read with read_surf, stored in the manifest so a converted
+        surface can be loaded with the same display without reading its gifti files.
+        """
+        return {
+            "active_scalar": surface["active_scalar"],
+            "colortable": surface["colortable"],
+            "scalar_range": [float(value) for value in surface["scalar_range"]],
+        }
+
+    def read_dseg(self, dseg_file):
+        """
+        Reads a nifti segmentation and its colortable and prepares the segmentation arrays
+        (see prepare_dseg).
+        """
+        import nibabel as nb
+
+        dseg, (colortable, show_unknown, *_) = dseg_file
+        # Read colortable
+        atlas_labels = self.getColortable(colortable)
+        # Load data from dseg file
+        data_obj = nb.load(dseg)
+        return self.prepare_dseg(data_obj, atlas_labels, show_unknown)
+
+    def read_surf(self, surf_file):
+        """
+        Reads a gifti surface and its scalars. Returns a dictionary with the vertices, faces,
+        the key of the faces (see facesKey), scalars (scalar name -> array), the file of each
+        scalar (scalar name -> path), the active scalar and, if the active scalar has a
+        colortable, the colortable path and the scalar range.
+        """
+        surf, label_files = surf_file
+        # Extract geometric data (the other data arrays of the file are not decoded)
+        vertices, faces = gifti.read_surface(surf)
+        # Extract color data and add scalars (scalar name -> array of values per vertex)
+        arrayScalars = {}
+        scalar_files = {}
+        active_scalar = None
+        active_colortable = None
+        scalar_range = []
+        for index, (label_file, colortable) in enumerate(label_files):
+            # Scalar files shared by several surfaces are only decoded once
+            vert_colors_idx = self.readScalar(label_file)
+            name_label = os.path.basename(label_file).split(".", 1)[0].split("-")[-1]
+            # Scalar files with the same name (e.g. from different folders) are numbered
+            base_name, number = name_label, 2
+            while name_label in arrayScalars:
+                name_label = f"{base_name}_{number}"
+                number += 1
+            # Append scalars into the dictionary of scalars
+            arrayScalars[name_label] = vert_colors_idx
+            scalar_files[name_label] = label_file
+            # Case 1: Scalar + colortable
+            # Extract colors from df if a colortable was given
+            if colortable != None:
+                # Set any scalar with colortable as the active scalar
+                active_scalar = name_label
+                active_colortable = colortable
+                # Extract the range of the active scalar
+                indexes = self.getColortable(colortable)["index"]
+                scalar_range = (indexes[0], indexes[-1])
+            # Case 2: Scalar without colotable.
+            # Set as active scalar only if there's no defined active scalar and this is the last scalar file
+            elif active_scalar == None and index == len(label_files) - 1:
+                active_scalar = name_label
+        return {
+            "vertices": vertices,
+            "faces": faces,
+            "faces_key": self.facesKey(faces),
+            "scalars": arrayScalars,
+            "scalar_files": scalar_files,
+            "active_scalar": active_scalar,
+            "colortable": active_colortable,
+            "scalar_range": scalar_range,
+        }
+
+    def readScalar(self, scalar_file):
+        """
+        Reads the values of a gifti scalar file (one per vertex) as float32. Each file is decoded
+        once until clearScalarCache is called: threads asking for a file that is being decoded
+        wait for it, and all get the same array.
+        """
+        key = os.path.abspath(scalar_file)
+        with self._scalarsLock:
+            future = self._scalars.get(key)
+            decode = future is None
+            if decode:
+                future = self._scalars[key] = concurrent.futures.Future()
+        if decode:
+            try:
+                future.set_result(
+                    np.asarray(gifti.read_values(scalar_file), dtype=np.float32)
+                )
+            except Exception as error:
+                future.set_exception(error)
+        return future.result()
+
+    def sharedScalarArray(self, scalar_file, name, values):
+        """
+        Returns the vtkDataArray of a scalar file read with readScalar (with a component per
+        column of a time series). It is built once and attached to every surface using that
+        file with the same scalar name, until clearScalarCache is called.
+        """
+        from vtk.util import numpy_support
+
+        key = (os.path.abspath(scalar_file), name)
+        array = self._scalarArrays.get(key)
+        if array is None:
+            array = numpy_support.numpy_to_vtk(
+                np.ascontiguousarray(values, dtype=np.float32), deep=False
+            )
+            array.SetName(name)
+            self._scalarArrays[key] = array
+        return array
+
+    def clearScalarCache(self):
+        """
+        Forgets the scalar files already decoded (e.g. at the start of a new import, in case
+        they changed).
+        """
+        with self._scalarsLock:
+            self._scalars = {}
+        self._scalarArrays = {}
+
+    def write_surf(self, mesh, out_file):
+        """
+        Writes a vtkPolyData as legacy vtk (binary or ascii, see outputOptions) or, if out_file
+        ends with .vtp, as VTK XML (compressed with zlib, lz4 or not compressed).
+        """
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+        if out_file.endswith(".vtp"):
+            writer = vtk.vtkXMLPolyDataWriter()
+            compression = self.outputOptions["vtp_compression"]
+            if compression == "zlib":
+                writer.SetCompressorTypeToZLib()
+            elif compression == "lz4":
+                writer.SetCompressorTypeToLZ4()
+            else:
+                writer.SetCompressorTypeToNone()
+        else:
+            writer = vtk.vtkPolyDataWriter()
+            if self.outputOptions["vtk_encoding"] == "binary":
+                writer.SetFileTypeToBinary()
+            else:
+                writer.SetFileTypeToASCII()
+        writer.SetInputData(mesh)
+        writer.SetFileName(out_file)
+        writer.Write()
+
+    # Functions to compute files
+    def bounding_box(self, seg):
+        """
+        Defines bounding box around volumetric object. Returns None if the volume is empty.
+        """
+        # Single pass over the whole volume for the first two axes. The third axis is only
+        # scanned inside the extent found for the other two.
+        mask = np.any(seg, axis=2)
+        ymin, ymax = self._first_last(np.any(mask, axis=1))
+        if ymin is None:
+            return None
+        xmin, xmax = self._first_last(np.any(mask, axis=0))
+        zmin, zmax = self._first_last(
+            np.any(seg[ymin : ymax + 1, xmin : xmax + 1], axis=(0, 1))
+        )
+        bbox = np.array([ymin, ymax, xmin, xmax, zmin, zmax])
+        return bbox
+
+    def _first_last(self, mask):
+        """
+        Returns the first and last True index of a 1D mask (None, None if there is none).
+        """
+        indexes = np.flatnonzero(mask)
+        if indexes.size == 0:
+            return None, None
+        return indexes[0], indexes[-1]
+
+    def get_shape_origin(self, bbox):
+        """
+        Get shape of the volumetric data and defines the origin in one of its corners.
+        """
+        ymin, ymax, xmin, xmax, zmin, zmax = bbox
+        shape = list(np.array([ymax - ymin, xmax - xmin, zmax - zmin]) + 1)
+        origin = [ymin, xmin, zmin]
+        return shape, origin
+
+    def present_labels(self, seg_cut, cropped):
+        """
+        Returns the sorted labels present in the cropped volume. The background (0) is also
+        present if the volume was cropped, as everything outside of the bounding box is 0.
+        """
+        if seg_cut.dtype.kind == "u" and seg_cut.dtype.itemsize <= 2:
+            labels = np.flatnonzero(np.bincount(seg_cut.ravel()))
+        else:
+            labels = np.unique(seg_cut)
+        if cropped:
+            labels = np.union1d(labels, [0])
+        return labels.astype(int)
+
+    def make_label_lookup(self, colortable):
+        """
+        Builds a lookup (sorted label index -> abbreviation and RGBA color) from a colortable dataframe.
+        """
+        colortable = colortable.sort_values("index")
+        colors = colortable[["r", "g", "b"]].to_numpy(dtype=float) / 255
+        # Colortables of surface scalars only need index, r, g and b
+        for column in ["abbreviation", "name", "index"]:
+            if column in colortable:
+                names = colortable[column].to_numpy(dtype=str)
+                break
+        return {
+            "index": colortable["index"].to_numpy(dtype=int),
+            "abbreviation": names,
+            "color": np.hstack([colors, np.ones((len(colors), 1))]),
+        }
+
+    def getColortable(self, colortable):
+        """
+        Reads a colortable (tsv file) into a label lookup (see make_label_lookup). Colortables are
+        parsed once and cached by path and modification time.
+        """
+        import pandas as pd
+
+        key = self._colortableKey(colortable)
+        if key not in self._colortables:
+            self._colortables[key] = self.make_label_lookup(pd.read_table(colortable))
+        return self._colortables[key]
+
+    def _colortableKey(self, colortable):
+        """
+        Identifies a version of a colortable file (path, modification time and size).
+        """
+        stat = os.stat(colortable)
+        return (os.path.abspath(colortable), stat.st_mtime_ns, stat.st_size)
+
+    def prepare_dseg(self, data_obj, atlas_labels, show_unknown):
+        """
+        Crops a nifti segmentation and resolves its labels. atlas_labels is a lookup built with
+        make_label_lookup. Returns a dictionary with the cropped labels ('data'), the nrrd header
+        ('header'), the IJK to RAS matrix of the cropped volume ('ijkToRAS') and the segments
+        ('segments', list of (label value, name, RGBA color)).
+        """
+        import nibabel as nb
+
+        # Get data from the nifti in its native type (labels do not need float64)
+        data = np.asanyarray(data_obj.dataobj)
+
+        # Define some parameters for the nrrd
+        keyvaluepairs = {}
+        keyvaluepairs["dimension"] = 3
+        keyvaluepairs["encoding"] = "gzip"
+        keyvaluepairs["kinds"] = ["domain", "domain", "domain"]
+        keyvaluepairs["space"] = "right-anterior-superior"
+        keyvaluepairs["space directions"] = data_obj.affine[:3, :3].T
+
+        # Get bounding box, shape and origin of the object (whole volume if it is empty).
+        box = self.bounding_box(data)
+        if box is None:
+            box = np.array(
+                [0, data.shape[0] - 1, 0, data.shape[1] - 1, 0, data.shape[2] - 1]
+            )
+        seg_cut = data[box[0] : box[1] + 1, box[2] : box[3] + 1, box[4] : box[5] + 1]
+        # Store the labels with the smallest integer type that fits their range
+        if not np.issubdtype(seg_cut.dtype, np.integer):
+            seg_cut = np.rint(seg_cut)
+        low, high = int(seg_cut.min()), int(seg_cut.max())
+        seg_cut = seg_cut.astype(
+            np.min_scalar_type(min(low, -high - 1) if low < 0 else high), copy=False
+        )
+        keyvaluepairs["type"] = seg_cut.dtype.name
+        shape, origin = self.get_shape_origin(box)
+        origin = nb.affines.apply_affine(data_obj.affine, np.array([origin]))
+
+        keyvaluepairs["sizes"] = np.array([*shape])
+        keyvaluepairs["space origin"] = origin[0]
+        # Resolve the labels present in the volume against the colortable
+        labels = self.present_labels(seg_cut, seg_cut.shape != data.shape)
+        position = np.minimum(
+            np.searchsorted(atlas_labels["index"], labels),
+            len(atlas_labels["index"]) - 1,
+        )
+        known = atlas_labels["index"][position] == labels
+        if not show_unknown:
+            labels, position, known = labels[known], position[known], known[known]
+        names = np.where(known, atlas_labels["abbreviation"][position], "Unknown")
+        colors = np.where(known[:, np.newaxis], atlas_labels["color"][position], 0.0)
+        extent = f"0 {shape[0]-1} 0 {shape[1]-1} 0 {shape[2]-1}"
+        tags = (
+            "TerminologyEntry:Segmentation category"
+            + " and type - 3D Slicer General Anatomy list~SRT^T-D0050^Tissue~SRT^"
+            + "T-D0050^Tissue~^^~Anatomic codes - DICOM master list~^^~^^|"
+        )
+        # Set parameters for each different label in the nifti object
+        for i, (id, label_name, col_lut) in enumerate(zip(labels, names, colors)):
+            name = "Segment{}".format(i)
+            keyvaluepairs[name + "_Color"] = " ".join([f"{a:10.3f}" for a in col_lut])
+            keyvaluepairs[name + "_ColorAutoGenerated"] = "1"
+            keyvaluepairs[name + "_Extent"] = extent
+            keyvaluepairs[name + "_ID"] = "Segment_{}".format(id)
+            keyvaluepairs[name + "_LabelValue"] = "{}".format(id)
+            keyvaluepairs[name + "_Layer"] = "0"
+            keyvaluepairs[name + "_Name"] = label_name
+            keyvaluepairs[name + "_NameAutoGenerated"] = 1
+            keyvaluepairs[name + "_Tags"] = tags
+        keyvaluepairs["Segmentation_ContainedRepresentationNames"] = "Binary labelmap|"
+        keyvaluepairs["Segmentation_ConversionParameters"] = "placeholder"
+        keyvaluepairs["Segmentation_MasterRepresentation"] = "Binary labelmap"
+
+        ijkToRAS = data_obj.affine.copy()
+        ijkToRAS[:3, 3] = origin[0]
+        return {
+            "data": seg_cut,
+            "header": keyvaluepairs,
+            "ijkToRAS": ijkToRAS,
+            "segments": list(zip(labels.tolist(), names.tolist(), colors.tolist())),
+        }
+
+    def write_nrrd(self, seg, out_file):
+        """
+        Writes nrrd file based on a segmentation prepared with prepare_dseg, with the encoding
+        set in outputOptions.
+        """
+        import nrrd
+
+        options = self.outputOptions
+        header = dict(seg["header"], encoding=options["nrrd_encoding"])
+        if options["nrrd_encoding"] == "raw" or options["nrrd_threads"] == 1:
+            nrrd.write(
+                out_file,
+                seg["data"],
+                header,
+                compression_level=options["nrrd_compression_level"],
+            )
+            return
+        # Write the header and the raw data with pynrrd, then compress the data in parallel
+        buffer = io.BytesIO()
+        nrrd.write(buffer, seg["data"], dict(header, encoding="raw"))
+        content = buffer.getbuffer()
+        data_start = len(content) - seg["data"].nbytes
+        with open(out_file, "wb") as file:
+            file.write(
+                bytes(content[:data_start]).replace(
+                    b"\nencoding: raw\n", b"\nencoding: gzip\n", 1
+                )
+            )
+            file.write(
+                self.gzipBlocks(
+                    content[data_start:],
+                    options["nrrd_compression_level"],
+                    options["nrrd_threads"],
+                )
+            )
+
+    def gzipBlocks(self, data, level, threads):
+        """
+        Compresses data to gzip, compressing blocks of nrrdBlockSize bytes in parallel (zlib
+        releases the GIL). The blocks are joined into a single deflate stream (as pigz does), so
+        the result is a regular gzip file.
+        """
+        blocks = [
+            data[start : start + self.nrrdBlockSize]
+            for start in range(0, len(data), self.nrrdBlockSize)
+        ] or [b""]
+
+        def compress(index):
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            last = index == len(blocks) - 1
+            # Blocks but the last one end byte aligned, without the end of stream marker
+            return compressor.compress(blocks[index]) + compressor.flush(
+                zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+            )
+
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            deflate = b"".join(executor.map(compress, range(len(blocks))))
+        # gzip header (no file name nor modification time) and trailer (CRC32 and size)
+        header = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+        trailer = struct.pack("<II", zlib.crc32(data), len(data) & 0xFFFFFFFF)
+        return header + deflate + trailer
+
+    def write_closed_surfaces(self, surfaces, out_file, key):
+        """
+        Saves the closed surfaces of a segmentation (label value -> vtkPolyData) as a vtm file,
+        with the key (see closedSurfaceKey) they were generated with.
+        """
+        blocks = vtk.vtkMultiBlockDataSet()
+        for index, (label, polydata) in enumerate(surfaces.items()):
+            blocks.SetBlock(index, polydata)
+            blocks.GetMetaData(index).Set(vtk.vtkCompositeDataSet.NAME(), str(label))
+        keyArray = vtk.vtkStringArray()
+        keyArray.SetName(CLOSED_SURFACE_KEY)
+        keyArray.InsertNextValue(json.dumps(key, sort_keys=True))
+        blocks.GetFieldData().AddArray(keyArray)
+        writer = vtk.vtkXMLMultiBlockDataWriter()
+        writer.SetFileName(out_file)
+        writer.SetInputData(blocks)
+        if not writer.Write():
+            raise OSError(f"Failed to write {out_file}")
+
+    def read_closed_surfaces(self, in_file, key):
+        """
+        Reads the closed surfaces saved with write_closed_surfaces (label value -> vtkPolyData).
+        Returns None if they are missing or were generated with another key.
+        """
+        if not os.path.exists(in_file):
+            return None
+        reader = vtk.vtkXMLMultiBlockDataReader()
+        reader.SetFileName(in_file)
+        reader.Update()
+        blocks = reader.GetOutput()
+        keyArray = blocks.GetFieldData().GetAbstractArray(CLOSED_SURFACE_KEY)
+        if keyArray is None or keyArray.GetValue(0) != json.dumps(key, sort_keys=True):
+            return None
+        surfaces = {}
+        for index in range(blocks.GetNumberOfBlocks()):
+            label = int(blocks.GetMetaData(index).Get(vtk.vtkCompositeDataSet.NAME()))
+            # Empty surfaces are not saved
+            surfaces[label] = blocks.GetBlock(index) or vtk.vtkPolyData()
+        return surfaces
+
+    def makeProxy(self, polydata, reduction):
+        """
+        Returns a decimated copy of a surface with about a fraction reduction (from 0 to 1) of
+        its triangles removed. The points kept carry their point data (scalars), so the proxy is
+        displayed as the surface.
+        """
+        decimate = vtk.vtkDecimatePro()
+        decimate.SetInputData(polydata)
+        decimate.SetTargetReduction(reduction)
+        # Keep the topology and the boundary of open surfaces (e.g. hippocampus)
+        decimate.PreserveTopologyOn()
+        decimate.BoundaryVertexDeletionOff()
+        decimate.Update()
+        proxy = vtk.vtkPolyData()
+        proxy.ShallowCopy(decimate.GetOutput())
+        return proxy
+
+    def makePoints(self, verts):
+        """
+        Create vtkPoints wrapping (without copying) an array of vertices.
+        """
+        from vtk.util import numpy_support
+
+        pts = vtk.vtkPoints()
+        pts.SetData(
+            numpy_support.numpy_to_vtk(
+                np.ascontiguousarray(verts, dtype=np.float32), deep=False
+            )
+        )
+        return pts
+
+    def facesKey(self, faces):
+        """
+        Identifies a triangle array by its shape and a hash of its content. Surfaces with the same
+        topology (e.g. inner, midthickness and outer surfaces of the same density) have the same key.
+        """
+        digest = hashlib.blake2b(np.ascontiguousarray(faces), digest_size=16)
+        return (faces.shape, digest.hexdigest())
+
+    def sharedCells(self, faces, key=None):
+        """
+        Returns the vtkCellArray of a triangle array. It is built once and shared by all the
+        surfaces with the same faces (key is the facesKey of faces, if already computed), so the
+        connectivity is only kept once in memory.
+        """
+        if key is None:
+            key = self.facesKey(faces)
+        cells = self._sharedCells.get(key)
+        if cells is None:
+            cells = self._sharedCells[key] = self.makeCells(faces)
+        return cells
+
+    def clearSharedArrays(self):
+        """
+        Forgets the arrays shared between surfaces (they are kept while any mesh uses them).
+        """
+        self._sharedCells = {}
+
+    def makeCells(self, faces):
+        """
+        Create vtkCellArray of triangles wrapping (without copying, if faces are already of
+        vtkIdType) an array of faces.
+        """
+        from vtk.util import numpy_support
+
+        # Cells as offsets/connectivity arrays (gifti faces are always triangles)
+        id_type = numpy_support.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE]
+        connectivity = np.ascontiguousarray(faces, dtype=id_type).ravel()
+        offsets = np.arange(0, connectivity.size + 1, 3, dtype=id_type)
+        cells = vtk.vtkCellArray()
+        cells.SetData(
+            numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=False),
+            numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=False),
+        )
+        return cells
+
+    # Function to create vtkPolyData object
+    def makePolyData(self, verts, faces, arrayScalars=None):
+        """
+        Create vtkPolyData based on vertices, faces (array or vtkCellArray, e.g. shared with
+        other surfaces) and scalars (dictionary of scalar name -> array with one value per
+        vertex, or vtkDataArray shared with other surfaces). Recovered from:
+        https://github.com/stephan1312/SlicerEAMapReader/blob/2798100fe2aebf482a83b347c1cef18135f2df87/EAMapReader-Slicer-4.11/lib/Slicer-4.11/qt-scripted-modules/EAMapReader.py#L218-L290
+        https://programtalk.com/python-examples/vtk.vtkPolyData/
+        The numpy arrays are wrapped without copying (vtk.util.numpy_support keeps a reference
+        to the backing buffer on each vtk array), so the inputs are not duplicated in memory.
+        """
+        from vtk.util import numpy_support
+
+        # Build structure
+        mesh = vtk.vtkPolyData()
+        pts = self.makePoints(verts)
+        if isinstance(faces, vtk.vtkCellArray):
+            cells = faces
+        else:
+            cells = self.makeCells(faces)
+        mesh.SetPoints(pts)
+        mesh.SetPolys(cells)
+
+        # Add scalars
+        for name, values in (arrayScalars or {}).items():
+            if isinstance(values, vtk.vtkDataArray):
+                scalar = values
+            else:
+                scalar = numpy_support.numpy_to_vtk(
+                    np.ascontiguousarray(values, dtype=np.float32), deep=False
+                )
+                scalar.SetName(name)
+            mesh.GetPointData().AddArray(scalar)
+
+        return mesh
@@ -0,0 +1,154 @@
+"""
+Streaming reader of GIFTI files. The XML is parsed incrementally and only the data arrays with
+the requested intents are decoded, in parallel with the parsing (zlib releases the GIL). It is
+used instead of nibabel to read the surfaces and their scalars.
+"""
+import base64
+import concurrent.futures
+import os
+import threading
+import xml.etree.ElementTree as ET
+import zlib
+
+import numpy as np
+
+__all__ = ["read_arrays", "read_surface", "read_values"]
+
+# GIFTI data types
+_DTYPES = {
+    "NIFTI_TYPE_UINT8": np.uint8,
+    "NIFTI_TYPE_INT8": np.int8,
+    "NIFTI_TYPE_INT16": np.int16,
+    "NIFTI_TYPE_UINT16": np.uint16,
+    "NIFTI_TYPE_INT32": np.int32,
+    "NIFTI_TYPE_UINT32": np.uint32,
+    "NIFTI_TYPE_INT64": np.int64,
+    "NIFTI_TYPE_UINT64": np.uint64,
+    "NIFTI_TYPE_FLOAT32": np.float32,
+    "NIFTI_TYPE_FLOAT64": np.float64,
+}
+
+# Threads decoding the data arrays (shared by all the files being read), and the process that
+# created them (a forked process, e.g. of a process pool, has to create its own threads)
+_executor = None
+_executorPid = None
+_executorLock = threading.Lock()
+
+
+def _getExecutor():
+    global _executor, _executorPid
+    with _executorLock:
+        if _executor is None or _executorPid != os.getpid():
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                thread_name_prefix="ImportGiftiDecode"
+            )
+            _executorPid = os.getpid()
+        return _executor
+
+
+def _decode(text, attributes, directory):
+    """
+    Decodes the data of a DataArray element (text) given its attributes.
+    """
+    dtype = np.dtype(_DTYPES[attributes["DataType"]])
+    if attributes.get("Endian", "LittleEndian") == "BigEndian":
+        dtype = dtype.newbyteorder(">")
+    else:
+        dtype = dtype.newbyteorder("<")
+    dims = [
+        int(attributes[f"Dim{index}"])
+        for index in range(int(attributes["Dimensionality"]))
+    ]
+    count = int(np.prod(dims))
+    encoding = attributes["Encoding"]
+    if encoding == "GZipBase64Binary":
+        # The size of the decompressed data is known, so it is allocated only once
+        buffer = zlib.decompress(
+            base64.b64decode(text), bufsize=max(count * dtype.itemsize, 1)
+        )
+        data = np.frombuffer(buffer, dtype=dtype, count=count)
+    elif encoding == "Base64Binary":
+        data = np.frombuffer(base64.b64decode(text), dtype=dtype, count=count)
+    elif encoding == "ASCII":
+        data = np.array((text or "").split(), dtype=dtype)
+    elif encoding == "ExternalFileBinary":
+        data = np.fromfile(
+            os.path.join(directory, attributes["ExternalFileName"]),
+            dtype=dtype,
+            count=count,
+            offset=int(attributes.get("ExternalFileOffset") or 0),
+        )
+    else:
+        raise ValueError(f"Unknown GIFTI encoding '{encoding}'")
+    order = "F" if attributes.get("ArrayIndexingOrder") == "ColumnMajorOrder" else "C"
+    # Arrays are returned in the native byte order
+    return data.reshape(dims, order=order).astype(dtype.newbyteorder("="), copy=False)
+
+
+def read_arrays(path, intents=None, first=False):
+    """
+    Reads the data arrays of a GIFTI file whose intent is in intents (all of them if None).
+    If first is set, only the first array of each intent is read, and the file is only parsed
+    until all of them are found (the whole file is parsed if intents is None). Returns a list
+    of (intent, array) in the order of the file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    pending = None if intents is None else set(intents)
+    found = set()
+    arrays = []
+    attributes = None
+    for event, element in ET.iterparse(path, events=("start", "end")):
+        if element.tag == "DataArray":
+            if event == "start":
+                intent = element.get("Intent", "NIFTI_INTENT_NONE")
+                wanted = (pending is None or intent in pending) and not (
+                    first and intent in found
+                )
+                attributes = dict(element.attrib) if wanted else None
+            else:
+                # Release the parsed array
+                element.clear()
+                if pending is not None and first and not pending:
+                    break
+        elif element.tag == "Data" and event == "end" and attributes is not None:
+            intent = attributes.get("Intent", "NIFTI_INTENT_NONE")
+            future = _getExecutor().submit(_decode, element.text, attributes, directory)
+            arrays.append((intent, future))
+            attributes = None
+            found.add(intent)
+            if first and pending is not None:
+                pending.discard(intent)
+            element.clear()
+    return [(intent, future.result()) for intent, future in arrays]
+
+
+def read_surface(path):
+    """
+    Reads the vertices (POINTSET) and faces (TRIANGLE) of a GIFTI surface.
+    """
+    arrays = dict(
+        read_arrays(
+            path, ["NIFTI_INTENT_POINTSET", "NIFTI_INTENT_TRIANGLE"], first=True
+        )
+    )
+    for intent in ["NIFTI_INTENT_POINTSET", "NIFTI_INTENT_TRIANGLE"]:
+        if intent not in arrays:
+            raise ValueError(f"{os.path.basename(path)} has no {intent} data array")
+    return arrays["NIFTI_INTENT_POINTSET"], arrays["NIFTI_INTENT_TRIANGLE"]
+
+
+def read_values(path):
+    """
+    Reads the values of a GIFTI data file (e.g. shape or label): its data array, or the arrays
+    stacked as columns if the file is a time series (as nibabel's agg_data). Raises ValueError
+    if the file has no data array, or several that are not a time series.
+    """
+    arrays = read_arrays(path)
+    if len(arrays) == 1:
+        return arrays[0][1]
+    if arrays and all(intent == "NIFTI_INTENT_TIME_SERIES" for intent, _ in arrays):
+        return np.column_stack([data for _, data in arrays])
+    raise ValueError(
+        f"{os.path.basename(path)} has {len(arrays)} data arrays, expected one"
+        " (or a time series)"
+    )
@@ -0,0 +1,562 @@
+"""
+Offline benchmark of the conversion. It generates a synthetic BIDS dataset of HippUnfold-like
+derivatives (surfaces of several densities with their label and shape files, and subfield
+segmentations), then times each step of the conversion separately and reports the throughput
+and memory of each one as JSON:
+
+  * resolve_cold / resolve_warm: indexing the dataset and resolving the files of all the
+    subjects (as the module does when the config file is read), without and with the
+    persisted layout
+  * makePolyData: building the vtkPolyData of the surfaces (already read)
+  * convert_surf: reading, building and writing each surface with its scalars
+  * write_nrrd: writing the segmentations (already read) as seg.nrrd
+  * convert_dseg: reading, preparing and writing each segmentation
+
+The memory of each step is python_peak_bytes, the peak of the memory allocated by Python and
+numpy while it runs (traced with tracemalloc). Memory allocated by VTK and other C++ libraries
+is not traced, so it is underestimated for the steps building vtkPolyData (makePolyData and
+convert_surf). process_max_rss_bytes is the peak resident memory of the whole process since it
+started (including the previous steps and the dataset generation), not of the step alone.
+
+It does not need Slicer nor network access, only the module requirements (vtk, nibabel,
+pynrrd, pandas, pybids and pyyaml). If any of them is missing, it exits with SKIP_RETURN_CODE
+without running. It is not installed with the module, and is run from the source tree, e.g.:
+
+    PythonSlicer ImportGifti/Testing/Python/ImportGiftiBenchmark.py --subjects 4 --densities 0p5mm 1mm --output results.json
+
+A run on a tiny dataset is registered as a test, so the benchmark keeps working.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import numpy as np
+
+if __name__ == "__main__":
+    # Make ImportGiftiLib (in the module folder, two levels up) importable
+    sys.path.insert(
+        0,
+        os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    )
+
+from ImportGiftiLib import batch
+from ImportGiftiLib.conversion import MODULE_DIR, ImportGiftiConverter
+
+# Colortable of the synthetic segmentations and label files
+COLORTABLE = os.path.join(
+    MODULE_DIR, "Resources", "Data", "desc-subfields_atlas-bigbrain_dseg.tsv"
+)
+# Names of the shape files of each surface (scalar<index> after these)
+SHAPE_NAMES = ["thickness", "curvature", "gyrification", "surfarea"]
+# Python packages needed besides the ones of Slicer (module name -> pip package)
+REQUIREMENTS = {
+    "nibabel": "nibabel",
+    "nrrd": "pynrrd",
+    "pandas": "pandas",
+    "bids": "pybids",
+    "yaml": "pyyaml",
+}
+# Exit code of a run skipped because of missing requirements (SKIP_RETURN_CODE of its test)
+SKIP_RETURN_CODE = 77
+
+
+def missing_requirements():
+    """
+    Returns the pip packages of REQUIREMENTS that are not installed.
+    """
+    return [
+        package
+        for module, package in REQUIREMENTS.items()
+        if importlib.util.find_spec(module) is None
+    ]
+
+
+def make_sheet(vertices, radius=10.0, length=40.0):
+    """
+    Returns the vertices and triangles of a curved sheet (half a cylinder) with about the
+    given number of vertices, similar in shape to an unfolded hippocampus.
+    """
+    rows = max(2, int(round(np.sqrt(vertices / 2))))
+    cols = max(2, int(round(vertices / rows)))
+    u, v = np.meshgrid(np.linspace(0, np.pi, cols), np.linspace(0, length, rows))
+    points = np.column_stack(
+        [radius * np.cos(u).ravel(), v.ravel(), radius * np.sin(u).ravel()]
+    ).astype(np.float32)
+    index = np.arange(rows * cols).reshape(rows, cols)
+    a, b = index[:-1, :-1].ravel(), index[:-1, 1:].ravel()
+    c, d = index[1:, :-1].ravel(), index[1:, 1:].ravel()
+    faces = np.concatenate([np.column_stack([a, b, c]), np.column_stack([b, d, c])])
+    return points, faces.astype(np.int32)
+
+
+def _save_gifti(path, arrays):
+    import nibabel as nb
+
+    gifti = nb.gifti.GiftiImage()
+    for data, intent in arrays:
+        gifti.add_gifti_data_array(
+            nb.gifti.GiftiDataArray(
+                data, intent=intent, encoding="GIFTI_ENCODING_B64GZ"
+            )
+        )
+    nb.save(gifti, path)
+
+
+def generate_dataset(
+    bids_dir,
+    subjects=2,
+    densities=("0p5mm",),
+    vertices=(7262,),
+    scalars=4,
+    dseg_size=(64, 64, 64),
+    seed=0,
+):
+    """
+    Writes a synthetic BIDS dataset of HippUnfold derivatives in bids_dir. Each subject has,
+    for each hemisphere and density (with the number of vertices given for it), the inner,
+    midthickness and outer surfaces, a subfields label file and scalars shape files, and a
+    subfields segmentation of size dseg_size for each hemisphere. Returns a summary of the
+    dataset.
+    """
+    import nibabel as nb
+
+    if len(vertices) == 1:
+        vertices = list(vertices) * len(densities)
+    if len(vertices) != len(densities):
+        raise ValueError("Give one number of vertices, or one for each density")
+    rng = np.random.default_rng(seed)
+    labels = np.loadtxt(COLORTABLE, delimiter="\t", skiprows=1, usecols=0, dtype=int)
+    os.makedirs(bids_dir, exist_ok=True)
+    with open(os.path.join(bids_dir, "dataset_description.json"), "w") as file:
+        json.dump(
+            {
+                "Name": "ImportGifti benchmark",
+                "BIDSVersion": "1.8.0",
+                "DatasetType": "derivative",
+                "GeneratedBy": [{"Name": "ImportGifti benchmark"}],
+            },
+            file,
+        )
+    shape_names = SHAPE_NAMES[:scalars] + [
+        f"scalar{index}" for index in range(len(SHAPE_NAMES), scalars)
+    ]
+    counts = {"surf": 0, "label": 0, "shape": 0, "dseg": 0}
+    mesh_vertices = {}
+    for subject in range(1, subjects + 1):
+        subj = f"sub-{subject:03d}"
+        surf_dir = os.path.join(bids_dir, subj, "surf")
+        anat_dir = os.path.join(bids_dir, subj, "anat")
+        os.makedirs(surf_dir, exist_ok=True)
+        os.makedirs(anat_dir, exist_ok=True)
+        for hemi, side in [("L", -1), ("R", 1)]:
+            for density, count in zip(densities, vertices):
+                prefix = f"{subj}_hemi-{hemi}_space-T1w_den-{density}_label-hipp"
+                points, faces = make_sheet(count)
+                mesh_vertices[density] = len(points)
+                # Subject specific deformation
+                points = points * (1 + 0.05 * rng.standard_normal(3)).astype(np.float32)
+                points[:, 0] += side * 25
+                for surface, offset in [
+                    ("inner", -1),
+                    ("midthickness", 0),
+                    ("outer", 1),
+                ]:
+                    _save_gifti(
+                        os.path.join(surf_dir, f"{prefix}_{surface}.surf.gii"),
+                        [
+                            (
+                                points + np.float32([0, 0, offset]),
+                                "NIFTI_INTENT_POINTSET",
+                            ),
+                            (faces, "NIFTI_INTENT_TRIANGLE"),
+                        ],
+                    )
+                    counts["surf"] += 1
+                # Subfields along the long axis of the hippocampus
+                subfields = labels[
+                    np.minimum(
+                        (points[:, 1] / points[:, 1].max() * len(labels)).astype(int),
+                        len(labels) - 1,
+                    )
+                ].astype(np.int32)
+                _save_gifti(
+                    os.path.join(
+                        surf_dir, f"{prefix}_atlas-bigbrain_subfields.label.gii"
+                    ),
+                    [(subfields, "NIFTI_INTENT_LABEL")],
+                )
+                counts["label"] += 1
+                for name in shape_names:
+                    _save_gifti(
+                        os.path.join(surf_dir, f"{prefix}_{name}.shape.gii"),
+                        [
+                            (
+                                rng.standard_normal(len(points)).astype(np.float32),
+                                "NIFTI_INTENT_SHAPE",
+                            )
+                        ],
+                    )
+                    counts["shape"] += 1
+            # Ellipsoid of subfields in the center of the volume
+            grid = np.indices(dseg_size, dtype=np.float32)
+            center = (np.array(dseg_size, dtype=np.float32) - 1) / 2
+            radius = np.array(dseg_size, dtype=np.float32) / 3
+            inside = (
+                sum(
+                    ((grid[axis] - center[axis]) / radius[axis]) ** 2
+                    for axis in range(3)
+                )
+                <= 1
+            )
+            position = (grid[1] - center[1] + radius[1]) / (2 * radius[1])
+            subfields = labels[
+                np.clip((position * len(labels)).astype(int), 0, len(labels) - 1)
+            ]
+            data = np.where(inside, subfields, 0).astype(np.int16)
+            affine = np.diag([0.3, 0.3, 0.3, 1.0])
+            affine[:3, 3] = [side * 25, -20, -15]
+            nb.save(
+                nb.Nifti1Image(data, affine),
+                os.path.join(
+                    anat_dir,
+                    f"{subj}_hemi-{hemi}_space-cropT1w_desc-subfields_atlas-bigbrain_dseg.nii.gz",
+                ),
+            )
+            counts["dseg"] += 1
+    return {
+        "subjects": subjects,
+        "densities": dict(zip(densities, [mesh_vertices[d] for d in densities])),
+        "scalars": scalars,
+        "dseg_size": list(dseg_size),
+        "files": counts,
+        "bytes": _size(bids_dir),
+    }
+
+
+def write_config(config_file):
+    """
+    Writes a config file with the inputs of the synthetic dataset (as in the default config
+    file, with the scalars also matched by density).
+    """
+    import yaml
+
+    config = {
+        "pybids_inputs": {
+            "hipp_surf": {
+                "pybids_filters": {
+                    "extension": ".surf.gii",
+                    "space": "T1w",
+                    "suffix": ["inner", "midthickness", "outer"],
+                },
+                "scalars": {
+                    "labels": {
+                        "pybids_filters": {"extension": ".label.gii"},
+                        "match_entities": ["label", "hemi", "den"],
+                        "colortable": COLORTABLE,
+                    },
+                    "shapes": {
+                        "pybids_filters": {"extension": ".shape.gii"},
+                        "match_entities": ["label", "hemi", "den"],
+                    },
+                },
+            },
+            "dseg": {
+                "pybids_filters": {
+                    "extension": ".nii.gz",
+                    "suffix": "dseg",
+                    "datatype": "anat",
+                },
+                "colortable": COLORTABLE,
+                "show_unknown": False,
+            },
+        }
+    }
+    with open(config_file, "w") as file:
+        yaml.dump(config, file)
+
+
+def _size(path):
+    """
+    Total size of the files in a directory (or of a file).
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, filename))
+        for root, _, filenames in os.walk(path)
+        for filename in filenames
+    )
+
+
+def _maxRSS():
+    """
+    Peak resident memory of the process in bytes (None if it is not available).
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def measure(function, repeat=1, setup=None, memory=True, **amounts):
+    """
+    Times function (the best and mean of repeat runs, each one after calling setup), and
+    reports the throughput of each amount processed by a run (amount / second). If memory is
+    set, the peak of the memory allocated by Python and numpy (python_peak_bytes, without the
+    VTK allocations) is measured in an additional run (tracing slows down the allocations, so
+    it is not timed). process_max_rss_bytes is the peak memory of the process so far.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    result = {"seconds": min(times), "mean_seconds": sum(times) / len(times)}
+    for name, amount in amounts.items():
+        result[name] = amount
+        result[f"{name}_per_second"] = amount / min(times) if min(times) > 0 else None
+    if memory:
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            function()
+            result["python_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    result["process_max_rss_bytes"] = _maxRSS()
+    return result
+
+
+def run_benchmarks(bids_dir, config_file, work_dir, repeat=1, memory=True):
+    """
+    Times the steps of the conversion of all the subjects of a dataset (see the module
+    documentation), writing the outputs in work_dir. Returns the results of each step.
+    """
+    import yaml
+
+    with open(config_file) as file:
+        pybids_inputs = yaml.load(file, Loader=yaml.FullLoader)["pybids_inputs"]
+    bids_config = os.path.join(MODULE_DIR, "Resources", "Data", "bids.json")
+    database_dir = os.path.join(work_dir, "layouts")
+    output_dir = os.path.join(work_dir, "output")
+    results = {}
+    resolved = {}
+
+    def resolve():
+        converter = ImportGiftiConverter(database_dir)
+        layout = converter.getLayout(bids_dir, bids_config)
+        subjects = layout.get(return_type="id", target="subject")
+        resolved.update(converter.resolveFiles(layout, pybids_inputs, subjects))
+
+    def reset_database():
+        shutil.rmtree(database_dir, ignore_errors=True)
+
+    results["resolve_cold"] = measure(
+        resolve, repeat, setup=reset_database, memory=memory
+    )
+    results["resolve_warm"] = measure(resolve, repeat, memory=memory)
+    files = [file for subj in sorted(resolved) for file in resolved[subj]]
+    surf_files = [file for file in files if file[0].endswith(".surf.gii")]
+    dseg_files = [file for file in files if file[0].endswith(".nii.gz")]
+    for name in ["resolve_cold", "resolve_warm"]:
+        results[name]["files"] = len(files)
+        results[name]["files_per_second"] = len(files) / results[name]["seconds"]
+
+    converter = ImportGiftiConverter(database_dir)
+    surfaces = [converter.read_surf(file) for file in surf_files]
+    surf_vertices = sum(len(surface["vertices"]) for surface in surfaces)
+
+    def make_poly_data():
+        for surface in surfaces:
+            converter.makePolyData(
+                surface["vertices"], surface["faces"], surface["scalars"]
+            )
+
+    results["makePolyData"] = measure(
+        make_poly_data,
+        repeat,
+        memory=memory,
+        files=len(surfaces),
+        vertices=surf_vertices,
+    )
+    # Release the surfaces
+    surfaces.clear()
+
+    def clear_output():
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    def convert(files):
+        def run():
+            for file in files:
+                batch.convertFile(file, output_dir)
+
+        return run
+
+    surf_bytes = sum(
+        _size(path)
+        for surf, scalars in surf_files
+        for path in [surf] + [scalar for scalar, _ in scalars]
+    )
+    results["convert_surf"] = measure(
+        convert(surf_files),
+        repeat,
+        setup=clear_output,
+        memory=memory,
+        files=len(surf_files),
+        vertices=surf_vertices,
+        input_bytes=surf_bytes,
+    )
+
+    segs = [converter.read_dseg(file) for file in dseg_files]
+    seg_files = [
+        converter.outputFile(file[0], output_dir, ".seg.nrrd") for file in dseg_files
+    ]
+
+    def write_nrrd():
+        for seg, seg_file in zip(segs, seg_files):
+            os.makedirs(os.path.dirname(seg_file), exist_ok=True)
+            converter.write_nrrd(seg, seg_file)
+
+    results["write_nrrd"] = measure(
+        write_nrrd,
+        repeat,
+        setup=clear_output,
+        memory=memory,
+        files=len(segs),
+        voxels=sum(seg["data"].size for seg in segs),
+    )
+    results["write_nrrd"]["output_bytes"] = sum(_size(path) for path in seg_files)
+    segs.clear()
+
+    results["convert_dseg"] = measure(
+        convert(dseg_files),
+        repeat,
+        setup=clear_output,
+        memory=memory,
+        files=len(dseg_files),
+        input_bytes=sum(_size(file[0]) for file in dseg_files),
+    )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the conversion on a synthetic BIDS dataset of HippUnfold "
+        "derivatives, and report the results as JSON."
+    )
+    parser.add_argument("--subjects", type=int, default=2, help="number of subjects")
+    parser.add_argument(
+        "--densities",
+        nargs="+",
+        default=["0p5mm"],
+        help="densities of the surfaces (den entity)",
+    )
+    parser.add_argument(
+        "--vertices",
+        nargs="+",
+        type=int,
+        default=[7262],
+        help="number of vertices of the surfaces (one for all densities, or one per density)",
+    )
+    parser.add_argument(
+        "--scalars",
+        type=int,
+        default=4,
+        help="number of shape files of each surface (besides the label file)",
+    )
+    parser.add_argument(
+        "--dseg-size",
+        nargs=3,
+        type=int,
+        default=[64, 64, 64],
+        metavar=("X", "Y", "Z"),
+        help="size of the segmentation volumes",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="runs of each step (the best is reported)"
+    )
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="do not measure the peak of the Python allocations of each step",
+    )
+    parser.add_argument(
+        "--data-dir",
+        help="directory where the dataset and outputs are written and kept "
+        "(default: a temporary directory, removed at the end)",
+    )
+    parser.add_argument("--output", help="JSON file of the results (default: stdout)")
+    args = parser.parse_args(argv)
+    missing = missing_requirements()
+    if missing:
+        print(
+            "Benchmark skipped, the following Python packages are not installed: "
+            + ", ".join(missing)
+        )
+        return SKIP_RETURN_CODE
+
+    work_dir = args.data_dir or tempfile.mkdtemp(prefix="ImportGiftiBenchmark")
+    try:
+        bids_dir = os.path.join(work_dir, "bids")
+        config_file = os.path.join(work_dir, "config.yml")
+        start = time.perf_counter()
+        dataset = generate_dataset(
+            bids_dir,
+            subjects=args.subjects,
+            densities=args.densities,
+            vertices=args.vertices,
+            scalars=args.scalars,
+            dseg_size=args.dseg_size,
+        )
+        dataset["generation_seconds"] = time.perf_counter() - start
+        write_config(config_file)
+        benchmarks = run_benchmarks(
+            bids_dir,
+            config_file,
+            work_dir,
+            repeat=args.repeat,
+            memory=not args.no_memory,
+        )
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    import vtk
+
+    results = {
+        "dataset": dataset,
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "numpy": np.__version__,
+            "vtk": vtk.vtkVersion.GetVTKVersion(),
+        },
+        "benchmarks": benchmarks,
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())